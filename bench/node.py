@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import json
+import time
+import argparse
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+
+#json-rpc stand-in for the benchmarks: `record` proxies a real node and stores every response,
+#`serve` answers from the stored fixtures only, so a pipeline run needs no network
+
+TRY_AGGREGATE = Web3.toHex(Web3.keccak(text='tryAggregate(bool,(address,bytes)[])')[:4])
+
+
+def key(method, params):
+	return json.dumps([method, params], sort_keys=True)
+
+def multicall_data(method, params):
+	if method == 'eth_call' and isinstance(params[0], dict) and params[0].get('data', '').startswith(TRY_AGGREGATE):
+		return Web3.toBytes(hexstr=params[0]['data'])[4:]
+	return None
+
+
+#recorded responses by method and params; multicall sub-calls are stored apart so any grouping of them replays
+class Fixtures:
+	def __init__(self, path):
+		self.path = path
+		self.responses = {}
+		self.subcalls = {}
+		self.lock = threading.Lock()
+		try:
+			with open(path) as file:
+				for line in file:
+					entry = json.loads(line)
+					self.store(entry['method'], entry['params'], entry['response'])
+		except FileNotFoundError as e:
+			pass
+
+	def store(self, method, params, response):
+		self.responses[key(method, params)] = response
+		data = multicall_data(method, params)
+		if data is not None and 'result' in response:
+			calls = decode_abi(['bool', '(address,bytes)[]'], data)[1]
+			results = decode_abi(['(bool,bytes)[]'], Web3.toBytes(hexstr=response['result']))[0]
+			for (target, calldata), (success, returndata) in zip(calls, results):
+				self.subcalls[(target.lower(), calldata)] = (success, returndata)
+
+	def add(self, method, params, response):
+		with self.lock:
+			self.store(method, params, response)
+			with open(self.path, 'a') as file:
+				file.write(json.dumps({'method': method, 'params': params, 'response': response}) + '\n')
+
+	def get(self, method, params):
+		response = self.responses.get(key(method, params))
+		if response is None and multicall_data(method, params) is not None:
+			calls = decode_abi(['bool', '(address,bytes)[]'], multicall_data(method, params))[1]
+			results = [self.subcalls.get((target.lower(), calldata), (False, b'')) for target, calldata in calls]
+			response = {'result': Web3.toHex(encode_abi(['(bool,bytes)[]'], [results]))}
+		if response is None:
+			response = {'error': {'code': -32000, 'message': f'{method} not recorded'}}
+		return response
+
+
+def make_handler(fixtures, upstream, latency, head):
+	class Handler(BaseHTTPRequestHandler):
+		def log_message(self, *args):
+			pass
+
+		def do_POST(self):
+			body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+			calls = body if isinstance(body, list) else [body]
+			if upstream:
+				upstream_responses = requests.post(upstream, json=calls, timeout=120).json()
+				by_id = {x.get('id'): x for x in upstream_responses}
+			responses = []
+			for request in calls:
+				if head is not None and request['method'] == 'eth_blockNumber':
+					response = {'result': hex(head)}
+				elif upstream:
+					response = {k: v for k, v in by_id[request['id']].items() if k in ['result', 'error']}
+					fixtures.add(request['method'], request.get('params', []), response)
+				else:
+					response = fixtures.get(request['method'], request.get('params', []))
+				responses.append({'jsonrpc': '2.0', 'id': request.get('id'), **response})
+			if latency > 0:
+				time.sleep(latency)
+			data = json.dumps(responses if isinstance(body, list) else responses[0]).encode('UTF-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+	return Handler
+
+#head pins eth_blockNumber so recording and replay cover the same block range
+def start(fixtures, port, upstream=None, latency=0, head=None):
+	server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fixtures, upstream, latency, head))
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('mode',        help='record through an upstream node or serve the fixtures', choices=['record', 'serve'])
+	parser.add_argument('--fixtures',  help='recorded responses | bench/fixtures.jsonl', default='bench/fixtures.jsonl')
+	parser.add_argument('--upstream',  help='node to record from', default=None)
+	parser.add_argument('--port',      help='listen port | 8545', type=int, default=8545)
+	parser.add_argument('--latency',   help='seconds added to every served response | 0', type=float, default=0)
+	parser.add_argument('--head',      help='block number answered to eth_blockNumber', type=int, default=None)
+	args = parser.parse_args()
+
+	server = start(Fixtures(args.fixtures), args.port, args.upstream if args.mode == 'record' else None, args.latency, args.head)
+	print(f'{args.mode} on 127.0.0.1:{args.port} with {args.fixtures}')
+	while True:
+		time.sleep(1)
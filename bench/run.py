@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import yaml
+import redis
+from node import Fixtures, start
+
+#end-to-end benchmark: event, gateway and db processors run against the fixture node, a local redis and postgres
+#reports events/sec, per-stage latency percentiles from the BENCH_TRACE stamps and peak RSS per service
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = {
+	'processing': ('received', 'published'),
+	'transport': ('published', 'gateway'),
+	'storage': ('gateway', 'stored'),
+	'end_to_end': ('received', 'stored'),
+}
+
+
+#db-processor models register their table with hasura on import; the benchmark only needs a 200
+class HasuraStub(BaseHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers['Content-Length']))
+		self.send_response(200)
+		self.send_header('Content-Length', '2')
+		self.end_headers()
+		self.wfile.write(b'{}')
+
+def children(pid):
+	found = []
+	for stat in glob.glob('/proc/[0-9]*/stat'):
+		try:
+			with open(stat) as file:
+				fields = file.read().rsplit(')', 1)[1].split()
+			if int(fields[1]) == pid:
+				child = int(stat.split('/')[2])
+				found += [child] + children(child)
+		except (OSError, IndexError, ValueError) as e:
+			pass
+	return found
+
+#resident memory of a process and all its children in bytes
+def rss(pid):
+	total = 0
+	for p in [pid] + children(pid):
+		try:
+			with open(f'/proc/{p}/status') as file:
+				for line in file:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1]) * 1024
+		except OSError as e:
+			pass
+	return total
+
+def load_trace(directory):
+	events = {}
+	for path in glob.glob(os.path.join(directory, '*.jsonl')):
+		with open(path) as file:
+			for line in file:
+				try:
+					stamp = json.loads(line)
+				except ValueError as e:
+					continue
+				events.setdefault(stamp.pop('xhash'), {}).update(stamp)
+	return events
+
+def stored_count(directory):
+	count = 0
+	for path in glob.glob(os.path.join(directory, 'db-*.jsonl')):
+		with open(path) as file:
+			count += sum(1 for line in file)
+	return count
+
+def percentiles(values):
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	pick = lambda p: values[min(len(values) - 1, int(p * len(values)))] * 1000
+	return {'p50': round(pick(0.5), 2), 'p90': round(pick(0.9), 2), 'p99': round(pick(0.99), 2), 'max': round(values[-1] * 1000, 2), 'count': len(values)}
+
+#throughput runs from the first event reaching a worker to the last one stored, startup excluded
+def report(events, started, peak):
+	stored = [x['stored'] for x in events.values() if 'stored' in x]
+	received = [x['received'] for x in events.values() if 'received' in x]
+	elapsed = (max(stored) - min(received)) if len(stored) > 0 and len(received) > 0 else 0
+	return {
+		'events': len(stored),
+		'seconds': round(elapsed, 2),
+		'wall_seconds': round(time.time() - started, 2),
+		'events_per_sec': round(len(stored) / elapsed, 2) if elapsed > 0 else 0,
+		'latency_ms': {stage: percentiles([x[b] - x[a] for x in events.values() if a in x and b in x]) for stage, (a, b) in STAGES.items()},
+		'peak_rss_mb': {service: round(value / 2**20, 1) for service, value in peak.items()},
+	}
+
+#copy each service with the chain abi and query into a scratch directory, like the docker volumes do
+def prepare(workdir, query_path, chain):
+	for service in ['event-processor', 'gateway-processor', 'db-processor']:
+		shutil.copytree(os.path.join(ROOT, service), os.path.join(workdir, service), ignore=shutil.ignore_patterns('__pycache__'))
+	shutil.copy(os.path.join(ROOT, chain['abi']), os.path.join(workdir, 'event-processor', 'abi.json'))
+	shutil.copy(os.path.join(ROOT, chain['abi']), os.path.join(workdir, 'db-processor', 'abi.json'))
+	shutil.copy(query_path, os.path.join(workdir, 'event-processor', 'query.yaml'))
+
+def reset_db(env):
+	try:
+		import psycopg2
+		conn = psycopg2.connect(host=env['DB_HOST'], port=env['DB_PORT'], user=env['DB_USERNAME'], password=env['DB_PASSWORD'], dbname=env['DB_DATABASE'])
+		conn.autocommit = True
+		#stored consumer offsets would make the db-processor skip the fresh gateway log
+		conn.cursor().execute('DROP TABLE IF EXISTS xquery, xqueryoffset')
+		conn.close()
+	except Exception as e:
+		print(f'Could not reset the xquery tables: {e}')
+
+def run(args):
+	with open(args.query) as file:
+		chains = yaml.load(file, Loader=yaml.FullLoader)['chains']
+	chain = next(x for x in chains if args.chain in [None, x['name']])
+	workdir = tempfile.mkdtemp(prefix='xquery-bench-')
+	trace = os.path.join(workdir, 'trace')
+	os.makedirs(trace)
+	prepare(workdir, args.query, chain)
+
+	node = start(Fixtures(args.fixtures), args.port, args.upstream, args.latency, args.head)
+	hasura = ThreadingHTTPServer(('127.0.0.1', args.port + 1), HasuraStub)
+	threading.Thread(target=hasura.serve_forever, daemon=True).start()
+
+	env = {
+		**os.environ,
+		'NAME': chain['name'],
+		'CHAIN_HOST': f'http://127.0.0.1:{args.port}',
+		f"CHAIN_ABI_{chain['name']}": 'abi.json',
+		'HASURA_HOST': '127.0.0.1',
+		'HASURA_PORT': str(args.port + 1),
+		'ZMQ_GATEWAY_HOST': '127.0.0.1',
+		'TRANSPORT_DIR': workdir,
+		'BENCH_TRACE': trace,
+		'REDIS_HOST': os.environ.get('REDIS_HOST', '127.0.0.1'),
+		'REDIS_DB': os.environ.get('REDIS_DB', '15'),
+		'DB_HOST': os.environ.get('DB_HOST', '127.0.0.1'),
+		'DB_PORT': os.environ.get('DB_PORT', '5432'),
+		'DB_USERNAME': os.environ.get('DB_USERNAME', 'postgres'),
+		'DB_PASSWORD': os.environ.get('DB_PASSWORD', 'postgrespassword'),
+		'DB_DATABASE': os.environ.get('DB_DATABASE', 'postgres'),
+		'PYTHONUNBUFFERED': '1',
+	}
+	redis.Redis(host=env['REDIS_HOST'], password=env.get('REDIS_PASSWORD', 'Redis2022'), db=int(env['REDIS_DB'])).flushdb()
+	reset_db(env)
+
+	commands = {
+		'gateway': ('gateway-processor', f'{sys.executable} main.py'),
+		'db': ('db-processor', f'{sys.executable} schema.py && {sys.executable} migrate_db.py && {sys.executable} main.py'),
+		'event': ('event-processor', f'{sys.executable} index_topics.py && {sys.executable} main.py'),
+	}
+	processes = {}
+	peak = {name: 0 for name in commands}
+	started = time.time()
+	try:
+		#the services share the host, so each serves its metrics on its own port after the hasura stub
+		for index, (name, (directory, command)) in enumerate(commands.items()):
+			log = open(os.path.join(workdir, f'{name}.log'), 'w')
+			service_env = {**env, 'METRICS_PORT': str(args.port + 2 + index)}
+			processes[name] = subprocess.Popen(command, shell=True, cwd=os.path.join(workdir, directory), env=service_env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+		last_count = 0
+		last_change = time.time()
+		while time.time() - started < args.timeout:
+			time.sleep(0.5)
+			for name, process in processes.items():
+				peak[name] = max(peak[name], rss(process.pid))
+			count = stored_count(trace)
+			if count != last_count:
+				last_count = count
+				last_change = time.time()
+			if (args.events and count >= args.events) or (count > 0 and time.time() - last_change > args.idle):
+				break
+	finally:
+		for process in processes.values():
+			try:
+				os.killpg(process.pid, signal.SIGKILL)
+			except ProcessLookupError as e:
+				pass
+		node.shutdown()
+		hasura.shutdown()
+
+	result = report(load_trace(trace), started, peak)
+	result['workdir'] = workdir
+	print(json.dumps(result, indent=2))
+	if args.output:
+		with open(args.output, 'w') as file:
+			json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--query',     help='query file with the chain to index | uniswap-query.yaml', default=os.path.join(ROOT, 'uniswap-query.yaml'))
+	parser.add_argument('--chain',     help='chain name in the query file | first chain', default=None)
+	parser.add_argument('--fixtures',  help='recorded json-rpc responses | bench/fixtures.jsonl', default=os.path.join(ROOT, 'bench', 'fixtures.jsonl'))
+	parser.add_argument('--upstream',  help='record the fixtures through this node instead of replaying them', default=None)
+	parser.add_argument('--head',      help='block answered to eth_blockNumber; pins the range between recording and replay', type=int, default=None)
+	parser.add_argument('--port',      help='fixture node port, the hasura stub and service metrics use the next ones | 8545', type=int, default=8545)
+	parser.add_argument('--latency',   help='seconds added to every node response | 0', type=float, default=0)
+	parser.add_argument('--events',    help='stop once this many events are stored', type=int, default=None)
+	parser.add_argument('--idle',      help='stop after this many seconds without a stored event | 30', type=float, default=30)
+	parser.add_argument('--timeout',   help='hard limit of the run in seconds | 1800', type=float, default=1800)
+	parser.add_argument('--output',    help='also write the report to this json file', default=None)
+	run(parser.parse_args())
@@ -3,8 +3,14 @@ import zmq
 import sys
 import ujson
 import json
+import time
 import yaml
+import socket as host
 from models import *
+from utils.trace import Trace
+from utils.wire import from_env
+from utils.writer import BatchWriter
+from prometheus_client import Counter, Histogram, start_http_server
 import logging
 
 logging.basicConfig(
@@ -25,73 +31,181 @@ def load_schema():
 	return order
 
 logger = logging.getLogger('main.py')
+trace = Trace('db')
+
+INSERTS = Counter('xquery_db_inserts_total', 'Trades written to the database by outcome', ['status'])
+BATCH_LATENCY = Histogram('xquery_db_batch_seconds', 'Time to load and commit one batch of trades')
+BATCH_SIZE = Histogram('xquery_db_batch_rows', 'Trades per committed batch', buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
+REQUIRED = ['query_name','blocknumber','chain_name','tx_hash','timestamp','xhash']
+
+def columns(xquery_yaml_order):
+	return [f'xquery_{x}' for x in REQUIRED] + [o[0] for o in xquery_yaml_order if o[0] != 'id']
+
+#one row in the order of columns(); missing or empty attributes are '' in str columns, which pony creates NOT NULL,
+#and NULL in the others
+def row(message, xquery_yaml_order):
+	values = [
+		message['query_name'],
+		int(message['blocknumber']),
+		message['chain_name'],
+		message['tx_hash'],
+		int(message['timestamp']),
+		message['xhash'],
+	]
+	fields = {f'xquery_{name.lower()}': value for name, value in message.items() if name.lower() not in REQUIRED}
+	for o in xquery_yaml_order:
+		if o[0] == 'id':
+			continue
+		value = fields.get(o[0])
+		v = '' if 'str' in o[1].lower() else None
+		if value and value !='':
+			if 'str' in o[1].lower():
+				v = str(value)
+			elif 'decimal' in o[1].lower():
+				v = int(str(value),0)
+			elif 'bool' in o[1].lower():
+				v = value.lower() in ['true','t']
+		values.append(v)
+	return values
 
 
-@db_session
 def main(xquery_yaml_order):
 	context = zmq.Context()
-	# socket = context.socket(zmq.PULL)
-	socket = context.socket(zmq.SUB)
-	socket.setsockopt_string(zmq.SUBSCRIBE, "")
-	socket.set_hwm(0)
+	wire = from_env()
+	#trades are written in batches of DB_BATCH rows, or sooner once the oldest has waited DB_FLUSH seconds
+	writer = BatchWriter(columns(xquery_yaml_order))
+	batch_size = int(os.environ.get('DB_BATCH', 1000))
+	flush_interval = float(os.environ.get('DB_FLUSH', 0.5))
+	#credit flow: the gateway log is read from the offset committed here, at most CREDIT_WINDOW batches ahead
+	credit = os.environ.get('GATEWAY_FLOW', 'pub') == 'credit'
+	window = int(os.environ.get('CREDIT_WINDOW', 4))
+	consumer_id = os.environ.get('CONSUMER_ID', host.gethostname())
+	#this instance claims CONSUMER_PARTITIONS, or every CONSUMER_COUNT-th partition from CONSUMER_INDEX;
+	#offsets belong to the consumer group and partition, so partitions can move between instances
+	partitions = int(os.environ.get('GATEWAY_PARTITIONS', 1))
+	if os.environ.get('CONSUMER_PARTITIONS'):
+		claimed = [int(x) for x in os.environ['CONSUMER_PARTITIONS'].split(',')]
+	else:
+		claimed = [p for p in range(0, partitions) if p % int(os.environ.get('CONSUMER_COUNT', 1)) == int(os.environ.get('CONSUMER_INDEX', 0))]
+	group = os.environ.get('CONSUMER_GROUP', 'db-processor')
+	next_offsets = {}
+	for p in claimed:
+		stored = writer.offset(f'{group}-{p}')
+		next_offsets[p] = stored if stored is not None else (-1 if os.environ.get('CONSUMER_START', 'earliest') == 'latest' else 0)
+	#offsets received but not committed yet, and the gateway batches to credit once they are
+	received = dict(next_offsets)
+	acks = []
+	deadline = None
+
+	def subscribe(p):
+		socket.send_multipart([b'subscribe', str(window).encode('UTF-8'), str(next_offsets[p]).encode('UTF-8'), str(p).encode('UTF-8')])
+
+	#a batch that fails to commit is read again from the committed offsets; in pub mode it is lost
+	def flush():
+		started = time.time()
+		count = len(writer.rows)
+		offsets = {f'{group}-{p}': offset + 1 for p, offset in acks}
+		try:
+			stored, errors = writer.flush(offsets)
+		except Exception as e:
+			INSERTS.labels('error').inc(count)
+			acks.clear()
+			received.update(next_offsets)
+			if credit:
+				for p in claimed:
+					subscribe(p)
+			return
+		BATCH_LATENCY.observe(time.time() - started)
+		BATCH_SIZE.observe(count)
+		INSERTS.labels('ok').inc(len(stored))
+		INSERTS.labels('duplicate').inc(count - len(stored) - errors)
+		INSERTS.labels('error').inc(errors)
+		for xhash in stored:
+			trace.stamp(xhash, stored=time.time())
+		logger.info(f'LOGGED {len(stored)} of {count} trades, offsets {offsets}')
+		for p, offset in acks:
+			next_offsets[p] = offset + 1
+			socket.send_multipart([b'credit', b'1', str(p).encode('UTF-8')])
+		acks.clear()
 
 	logger.info('Connecting...')
 
-	socket.connect("tcp://{}:{}".format(
-		os.environ.get('ZMQ_GATEWAY_HOST', 'gateway-processor'), os.environ.get('ZMQ_GATEWAY_PORT1', 5555)
-	))
+	if credit:
+		socket = context.socket(zmq.DEALER)
+		socket.setsockopt_string(zmq.IDENTITY, consumer_id)
+		socket.set_hwm(window * len(claimed))
+		socket.connect("tcp://{}:{}".format(
+			os.environ.get('ZMQ_GATEWAY_HOST', 'gateway-processor'), os.environ.get('ZMQ_GATEWAY_PORT3', 5557)
+		))
+		for p in claimed:
+			subscribe(p)
+		logger.info(f'Subscribed as {consumer_id} to partitions {next_offsets}')
+	else:
+		# socket = context.socket(zmq.PULL)
+		socket = context.socket(zmq.SUB)
+		for p in claimed:
+			socket.setsockopt_string(zmq.SUBSCRIBE, f'trades.{p}')
+		socket.set_hwm(int(os.environ.get('GATEWAY_HWM', 1000)))
+		socket.connect("tcp://{}:{}".format(
+			os.environ.get('ZMQ_GATEWAY_HOST', 'gateway-processor'), os.environ.get('ZMQ_GATEWAY_PORT1', 5555)
+		))
+		logger.info(f'Subscribed to partitions {claimed}')
 
 
 	while True:
 		try:
-			msg = socket.recv()
-			try:
-				j = ujson.loads(msg)
-			except Exception as e:
-				logger.critical("Exception ujson")
-				j = json.loads(msg)
-
-			if j['topic'] == 'trades':
-				for message in j['data']:
+			if deadline is not None:
+				timeout = max(0, deadline - time.time()) * 1000
+			else:
+				timeout = int(os.environ.get('CREDIT_REFRESH', 10)) * 1000 if credit else None
+			if not socket.poll(timeout):
+				if deadline is not None:
+					flush()
+					deadline = None
+				#an idle consumer subscribes again in case the gateway restarted and forgot it
+				elif credit:
+					for p in claimed:
+						subscribe(p)
+				continue
+			if credit:
+				frames = socket.recv_multipart()
+				partition, offset = int(frames[0]), int(frames[1])
+				topic, data = wire.decode(frames[2:])
+				#batches sent again after a resubscribe are already stored or pending
+				if received[partition] >= 0 and offset < received[partition]:
+					socket.send_multipart([b'credit', b'1', frames[0]])
+					continue
+				received[partition] = offset + 1
+			else:
+				topic, data = wire.recv(socket)
+				#subscriptions match by prefix, trades.1 also receives trades.10
+				if topic.startswith('trades.') and int(topic.split('.')[1]) not in claimed:
+					continue
+				topic = topic.split('.')[0]
+
+			if topic == 'trades':
+				for message in data:
 					try:
 						logger.info(f'RECEIVED QUERY:{message["query_name"]} XHASH:{message["xhash"]} TX:{message["tx_hash"]}')
-						item = XQuery(
-							xquery_query_name = message['query_name'],
-							xquery_chain_name = message['chain_name'],
-							xquery_timestamp = int(message['timestamp']),
-							xquery_tx_hash = message['tx_hash'],
-							xquery_xhash = message['xhash'],
-							xquery_blocknumber = int(message['blocknumber'])
-							)
-					
-						for o in xquery_yaml_order:
-							for name, value in message.items():
-								if o[0] == f'xquery_{name.lower()}' and name.lower() not in ['query_name','blocknumber','chain_name','tx_hash','timestamp','xhash']:
-									if value and value !='':
-										if 'str' in o[1].lower():
-											v = str(value)
-										elif 'decimal' in o[1].lower():
-											v = int(str(value),0)
-										elif 'bool' in o[1].lower():
-											if value.lower() in ['true','t']:
-												v = True
-											else:
-												v = False
-										d = {f'xquery_{name.lower()}':v}
-										item.set(**d)
-						parsed = item.to_dict()
-						for o in xquery_yaml_order:
-							if o[0] not in list(parsed):
-								d = {o[0]:None}
-								item.set(**d)
-						commit()
-						logger.info(f'LOGGED QUERY:{message["query_name"]} XHASH:{message["xhash"]} TX:{message["tx_hash"]}')
+						writer.add(row(message, xquery_yaml_order))
 					except Exception as e:
+						INSERTS.labels('error').inc()
 						logger.critical("Exception: ",exc_info=True)
+				if credit:
+					acks.append((partition, offset))
+				if deadline is None:
+					deadline = time.time() + flush_interval
+				#the gateway sends a partition nothing more until its window of batches is committed
+				full = credit and len([x for x in acks if x[0] == partition]) >= window
+				if len(writer.rows) >= batch_size or full or time.time() >= deadline:
+					flush()
+					deadline = None
 		except Exception as e:
 			logger.critical("Exception: ",exc_info=True)
 
 
 if __name__ == "__main__":
 	xquery_yaml_order = load_schema()
+	start_http_server(int(os.environ.get('METRICS_PORT', 9100)))
 	main(xquery_yaml_order)
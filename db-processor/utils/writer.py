@@ -0,0 +1,99 @@
+import io
+import os
+import csv
+import logging
+import psycopg2
+
+
+#trades are loaded into xquery in batches: one COPY into a temporary staging table, then one INSERT ... SELECT
+#with ON CONFLICT (xquery_xhash) DO NOTHING, so a trade stored before is skipped instead of aborting the batch
+#the consumer offsets of the batch are written in the same transaction, so trades and offsets commit together
+class BatchWriter:
+	def __init__(self, columns):
+		self.logger = logging.getLogger('BatchWriter')
+		self.columns = columns
+		self.rows = []
+		self.not_null = []
+		self.connection = None
+		self.connect()
+
+	def connect(self):
+		if self.connection is not None:
+			try:
+				self.connection.close()
+			except Exception as e:
+				pass
+		self.connection = psycopg2.connect(
+			host=os.environ['DB_HOST'],
+			port=os.environ['DB_PORT'],
+			user=os.environ['DB_USERNAME'],
+			password=os.environ['DB_PASSWORD'],
+			dbname=os.environ['DB_DATABASE'])
+		columns = ', '.join(self.columns)
+		with self.connection.cursor() as cursor:
+			cursor.execute(f'CREATE TEMPORARY TABLE xquery_staging ON COMMIT DELETE ROWS AS SELECT {columns} FROM xquery WITH NO DATA')
+			#csv cannot tell '' from NULL, so empty fields of NOT NULL text columns are loaded as ''
+			cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'xquery' AND is_nullable = 'NO' AND data_type IN ('text', 'character varying')")
+			text = {x[0] for x in cursor.fetchall()}
+		self.not_null = [x for x in self.columns if x in text]
+		self.connection.commit()
+
+	def offset(self, consumer):
+		with self.connection.cursor() as cursor:
+			cursor.execute('SELECT next_offset FROM xqueryoffset WHERE consumer = %s', (consumer,))
+			stored = cursor.fetchone()
+		self.connection.commit()
+		return stored[0] if stored else None
+
+	def add(self, row):
+		self.rows.append(row)
+
+	def load(self, cursor, rows):
+		columns = ', '.join(self.columns)
+		buffer = io.StringIO()
+		csv.writer(buffer).writerows(rows)
+		buffer.seek(0)
+		#unquoted empty fields are NULL in csv COPY, except in the NOT NULL text columns
+		force = f', FORCE_NOT_NULL ({", ".join(self.not_null)})' if len(self.not_null) > 0 else ''
+		cursor.copy_expert(f'COPY xquery_staging ({columns}) FROM STDIN WITH (FORMAT csv{force})', buffer)
+		cursor.execute(f'INSERT INTO xquery ({columns}) SELECT {columns} FROM xquery_staging ON CONFLICT (xquery_xhash) DO NOTHING RETURNING xquery_xhash')
+		stored = [x[0] for x in cursor.fetchall()]
+		cursor.execute('TRUNCATE xquery_staging')
+		return stored
+
+	#writes the pending rows and offsets {consumer: next_offset}; returns the xhashes stored and the number of rows
+	#rejected by the database; a batch with a bad row is loaded again row by row so only that row is lost
+	def flush(self, offsets={}):
+		rows = self.rows
+		self.rows = []
+		errors = 0
+		try:
+			with self.connection.cursor() as cursor:
+				try:
+					stored = self.load(cursor, rows)
+				except psycopg2.OperationalError:
+					raise
+				except psycopg2.DatabaseError as e:
+					self.logger.info(f'Batch of {len(rows)} rejected, loading row by row: {e}')
+					self.connection.rollback()
+					stored = []
+					for row in rows:
+						cursor.execute('SAVEPOINT xquery_row')
+						try:
+							stored += self.load(cursor, [row])
+							cursor.execute('RELEASE SAVEPOINT xquery_row')
+						except psycopg2.OperationalError:
+							raise
+						except psycopg2.DatabaseError as e:
+							self.logger.critical(f'Rejected {row}: {e}')
+							cursor.execute('ROLLBACK TO SAVEPOINT xquery_row')
+							errors += 1
+				for consumer, next_offset in offsets.items():
+					cursor.execute('INSERT INTO xqueryoffset (consumer, next_offset) VALUES (%s, %s) ON CONFLICT (consumer) DO UPDATE SET next_offset = EXCLUDED.next_offset', (consumer, next_offset))
+			self.connection.commit()
+		except Exception as e:
+			#nothing of the batch is committed; the caller replays it from its offsets
+			self.logger.critical('Batch lost, reconnecting', exc_info=True)
+			self.connect()
+			raise
+		return stored, errors
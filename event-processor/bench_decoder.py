@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import argparse
+import requests
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+from index_topics import get_dict
+from utils.registry import DecoderRegistry
+
+#micro-benchmark of web3 processLog/toJSON decoding against the fast static-layout decoder on recorded logs
+
+def load_abi(path):
+	with open(path) as file:
+		abi = json.load(file)
+		return abi['abi'] if isinstance(abi, dict) else abi
+
+#record raw eth_getLogs results for the abi event topics
+def record(host, abi, from_block, to_block, output):
+	topics = [x['topic'] for x in get_dict(abi).get('event', [])]
+	payload = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_getLogs', 'params': [{
+		'fromBlock': hex(from_block),
+		'toBlock': hex(to_block),
+		'topics': [topics]
+	}]}
+	resp = requests.post(host, headers={'Content-Type': 'application/json'}, json=payload, timeout=120)
+	logs = resp.json()['result']
+	with open(output, 'w') as file:
+		json.dump(logs, file)
+	print(f'Recorded {len(logs)} logs to {output}')
+
+def timed(label, fn, logs, repeat):
+	start = time.perf_counter()
+	for i in range(repeat):
+		result = fn(logs)
+	elapsed = time.perf_counter() - start
+	print(f'{label:<12} {len(logs)*repeat/elapsed:>12.0f} logs/s  {elapsed*1e6/(len(logs)*repeat):>8.2f} us/log')
+	return result
+
+def bench(abi, path, repeat):
+	with open(path) as file:
+		logs = [log_entry_formatter(x) for x in json.load(file)]
+	index_topics = get_dict(abi)
+	slow = DecoderRegistry(Web3(), index_topics, [abi], [], fast=False)
+	fast = DecoderRegistry(Web3(), index_topics, [abi], [], fast=True)
+	logs = [x for x in logs if len(x['topics']) > 0 and x['topics'][0].hex() in slow.events]
+	if len(logs) == 0:
+		print('No decodable logs in file')
+		return
+	expected = timed('web3', slow.decode_events, logs, repeat)
+	single = timed('fast', lambda logs: [fast.decode_event(x['topics'][0].hex(), x) for x in logs], logs, repeat)
+	batch = timed('fast batch', fast.decode_events, logs, repeat)
+	mismatches = sum(1 for a, b, c in zip(expected, single, batch) if not a == b == c)
+	print(f'{len(logs)} logs, {mismatches} mismatches')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--abi',    help='abi file with the events to decode | RC20.json', default='RC20.json')
+	parser.add_argument('--logs',   help='recorded eth_getLogs result | logs.json', default='logs.json')
+	parser.add_argument('--repeat', help='decode passes over the recorded logs | 20', type=int, default=20)
+	parser.add_argument('--record', help='record logs of a block range from CHAIN_HOST first | FROM TO', type=int, nargs=2)
+	args = parser.parse_args()
+
+	abi = load_abi(args.abi)
+	if args.record:
+		record(os.environ.get('CHAIN_HOST', 'https://api.avax.network/ext/bc/C/rpc').split(',')[0].split('#')[0], abi, args.record[0], args.record[1], args.logs)
+	bench(abi, args.logs, args.repeat)
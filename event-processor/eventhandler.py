@@ -1,4 +1,4 @@
-def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
+def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type, shard=0):
 	import os
 	import json
 	import time
@@ -13,14 +13,35 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 	import random
 	import requests
 	import redis
+	import asyncio
+	import signal
+	import sys
+	from queue import Empty
+	from collections import deque
+	from threading import Thread
+	from concurrent.futures import ThreadPoolExecutor
+	from utils.rpc import BatchRPC, AsyncBatchRPC
+	from utils.pool import RPCPool, PoolProvider
+	from utils.registry import DecoderRegistry
+	from utils.tokens import TokenCache, MULTICALL3_ADDRESS
+	from utils.blocks import BlockStore
+	from utils.dedup import EventDedup
+	from utils.transactions import TransactionStore
+	from utils.ws import LogSubscription
+	from utils.archive import SegmentArchive
+	from utils.trace import Trace
+	from utils.metrics import STAGE_LATENCY, EVENTS, HEAD, observe_cursor
+	from web3.datastructures import AttributeDict
+	from web3._utils.method_formatters import log_entry_formatter
 
 	class EventHandler:
-		def __init__(self, web2: Web3, web3: Web3, web4: Web3, zmq_queue, event_queue):
+		def __init__(self, web2: Web3, web3: Web3, web4: Web3, rpc, zmq_queue, event_queue, shard=0):
 			self.logger = logging.getLogger("EventHandler")
 			self.chain_name = os.environ.get('NAME','AVAX')
 			self.web2 = web2
 			self.web3 = web3
 			self.web4 = web4
+			self.rpc = rpc
 			self.codec: ABICodec = web4.codec
 			self.event_queue = event_queue
 			self.zmq_queue = zmq_queue
@@ -29,21 +50,79 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 			self.abi = self.load_abi()
 			self.rc_abi = self.load_rc_abi()
 			self.topics = self.get_topics_for_query()
+			self.registry = DecoderRegistry(web4, self.index_topics, [self.rc_abi['abi'], self.abi['abi']], [self.abi['abi'], self.rc_abi['abi']],
+				fast=os.environ.get('FAST_DECODER', 'true').lower() in ['true', '1'])
 			self.address = self.get_address_filter_input()
+			self.contracts = self.get_contract_filter_input()
+			self.node_filter = os.environ.get('NODE_FILTER', 'true').lower() in ['true', '1']
+			self.log_filter = self.get_log_filter()
 			self.get_latest_block()
 			self.start_block = self.load_start_block()
 			self.lock_forward = False
-			self.lock_backward = False
-			self.lock_queue = False
 			self.back_running = True
 			self.running = True
 			self.errors = 0
-			self.redis_cache = redis.Redis(host='xquery-redis', password='Redis2022')
-			self.current_block = int.from_bytes(self.redis_cache.get('backblock_progress'), 'big') if self.redis_cache.exists('backblock_progress') else self.start_block
-			self.current_block_forward = int.from_bytes(self.redis_cache.get('forwardblock_progress'), 'big') if self.redis_cache.exists('forwardblock_progress') else self.latest_block
+			self.redis_cache = redis.Redis(host=os.environ.get('REDIS_HOST', 'xquery-redis'),
+				password=os.environ.get('REDIS_PASSWORD', 'Redis2022'),
+				db=int(os.environ.get('REDIS_DB', 0)))
+			self.trace = Trace('event')
+			self.token_cache = TokenCache(rpc, self.codec, self.redis_cache,
+				size=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+				multicall=os.environ.get('MULTICALL_ADDRESS', MULTICALL3_ADDRESS))
+			#raw data fetched from the node is archived to ARCHIVE_DIR, ARCHIVE_REPLAY reads it back instead
+			self.replay = os.environ.get('ARCHIVE_REPLAY', 'false').lower() in ['true', '1']
+			self.archive = SegmentArchive(os.environ['ARCHIVE_DIR'], self.chain_name,
+				segment_blocks=int(os.environ.get('ARCHIVE_SEGMENT_BLOCKS', 10000)),
+				flush_rows=int(os.environ.get('ARCHIVE_FLUSH_ROWS', 50000)),
+				flush_interval=int(os.environ.get('ARCHIVE_FLUSH_INTERVAL', 60))) if os.environ.get('ARCHIVE_DIR') else None
+			self.blocks = BlockStore(rpc, self.redis_cache, self.chain_name,
+				size=int(os.environ.get('BLOCK_CACHE_SIZE', 10000)),
+				ttl=int(os.environ.get('BLOCK_CACHE_TTL', 86400)),
+				archive=None if self.replay else self.archive)
+			self.transactions = TransactionStore(rpc, self.decode_function, self.blocks,
+				size=int(os.environ.get('TX_CACHE_SIZE', 50000)),
+				archive=self.archive,
+				replay=self.replay)
+			#a replay reads each archived log once and is meant to be repeatable, so it skips the dedup;
+			#trades it publishes again are dropped by the gateway and the database on their xhash
+			self.dedup = None if self.replay else EventDedup(self.redis_cache, self.chain_name,
+				range_size=int(os.environ.get('DEDUP_RANGE', 1000)),
+				range_ttl=int(os.environ.get('DEDUP_RANGE_TTL', 3600)),
+				capacity=int(os.environ.get('DEDUP_CAPACITY', 1000000)),
+				error_rate=float(os.environ.get('DEDUP_ERROR_RATE', 0.000001)),
+				layer_bits=int(os.environ.get('DEDUP_LAYER_BITS', 2**30)))
+			self.shard = shard
+			self.shards = int(os.environ.get('BACKWARD_SHARDS', 1))
+			self.backfill_head = self.load_backfill_head()
+			self.shard_plan = self.load_shard_plan()
+			#a shard works through its ranges in order; the range it starts with and the end of the last one
+			self.shard_ranges = self.shard_plan[shard] if shard < len(self.shard_plan) else []
+			self.shard_from = self.shard_ranges[0][0] if len(self.shard_ranges) > 0 else 0
+			self.shard_to = self.shard_ranges[-1][1] if len(self.shard_ranges) > 0 else 0
+			self.current_block = int(self.redis_cache.get(f'backblock_progress-{shard}')) if self.redis_cache.exists(f'backblock_progress-{shard}') else self.shard_from
+			self.current_block_forward = int(self.redis_cache.get('forwardblock_progress')) if self.redis_cache.exists('forwardblock_progress') else self.backfill_head
+			self.back_window = int(os.environ.get('BACKFILL_WINDOW', 100))
+			self.back_window_min = int(os.environ.get('BACKFILL_MIN_WINDOW', 1))
+			self.back_retry_delay = float(os.environ.get('BACKFILL_RETRY_DELAY', 5))
+			self.back_window_max = int(os.environ.get('BACKFILL_MAX_WINDOW', 5000))
+			self.back_target_logs = int(os.environ.get('BACKFILL_TARGET_LOGS', 5000))
+			self.ws_host = os.environ.get('CHAIN_WS_HOST')
+			self.ws_log_grace = float(os.environ.get('WS_LOG_GRACE', 0.2))
+			self.ws_head_timeout = float(os.environ.get('WS_HEAD_TIMEOUT', 60))
+			self.ws_reconnect_delay = float(os.environ.get('WS_RECONNECT_DELAY', 5))
+			self.stats_interval = int(os.environ.get('STATS_INTERVAL', 60))
+			self.stats_time = time.time()
+			#events whose block the node did not serve yet are retried by this process every BLOCK_RETRY_DELAY
+			#seconds, BLOCK_RETRIES times, keeping the dedup mark they already set
+			self.block_retries = int(os.environ.get('BLOCK_RETRIES', 10))
+			self.block_retry_delay = float(os.environ.get('BLOCK_RETRY_DELAY', 1))
+			self.retry_events = deque()
+			self.logs_received = 0
+			self.logs_dropped = 0
 
 		def get_latest_block(self):
 			self.latest_block = int(self.web4.eth.block_number)-1
+			HEAD.set(self.latest_block)
 
 		#load start_block if any
 		def load_start_block(self):
@@ -53,6 +132,67 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 				start_block = int(sb) if sb.isdigit() else sb
 			return start_block
 
+		#first block handled by the forward listener; backward shards stop right before it
+		def load_backfill_head(self):
+			head = int(self.redis_cache.get('forwardblock_progress')) if self.redis_cache.exists('forwardblock_progress') else self.latest_block
+			self.redis_cache.setnx('backfill_head', head)
+			return int(self.redis_cache.get('backfill_head'))
+
+		#split historical range into contiguous shards; the first process to start stores the plan so restarts keep the same shards
+		#each shard holds a list of [from, to) ranges; once BACKWARD_SHARDS changes, the first process to start splits
+		#what the stored plan has not done yet across the new shard count and resets the shard progress
+		def load_shard_plan(self):
+			if self.start_block == 'None':
+				return []
+			start = int(self.redis_cache.get('backblock_progress')) if self.redis_cache.exists('backblock_progress') else self.start_block
+			size = -(-max(0, self.backfill_head - start) // self.shards)
+			plan = [[[min(start + i*size, self.backfill_head), min(start + (i+1)*size, self.backfill_head)]] for i in range(self.shards)]
+			self.redis_cache.setnx('backfill_shards', json.dumps(plan))
+			while True:
+				with self.redis_cache.pipeline() as pipe:
+					try:
+						pipe.watch('backfill_shards')
+						#plans stored before shards held several ranges have one [from, to) per shard
+						plan = [x if len(x) == 0 or isinstance(x[0], list) else [x] for x in json.loads(pipe.get('backfill_shards'))]
+						if len(plan) == self.shards:
+							return plan
+						keys = [f'backblock_progress-{i}' for i in range(0, len(plan))]
+						pipe.watch('backfill_shards', *keys)
+						remaining = []
+						for ranges, progress in zip(plan, pipe.mget(keys)):
+							for f, t in ranges:
+								f = max(f, int(progress)) if progress is not None else f
+								if f < t:
+									remaining.append([f, t])
+						resplit = self.split_backfill(sorted(remaining))
+						pipe.multi()
+						pipe.set('backfill_shards', json.dumps(resplit))
+						pipe.delete(*keys)
+						pipe.execute()
+						self.logger.info(f'{self.chain_name} backfill plan of {len(plan)} shards split again into {self.shards}: {resplit}')
+						return resplit
+					except redis.WatchError as e:
+						continue
+
+		#cut sorted block ranges into BACKWARD_SHARDS lists of ranges with about the same number of blocks each
+		def split_backfill(self, remaining):
+			size = -(-sum(t - f for f, t in remaining) // self.shards)
+			plan = [[] for i in range(0, self.shards)]
+			shard = 0
+			for f, t in remaining:
+				while f < t:
+					taken = sum(b - a for a, b in plan[shard])
+					if taken >= size and shard < self.shards - 1:
+						shard += 1
+						continue
+					end = t if shard == self.shards - 1 else min(t, f + size - taken)
+					if len(plan[shard]) > 0 and plan[shard][-1][1] == f:
+						plan[shard][-1][1] = end
+					else:
+						plan[shard].append([f, end])
+					f = end
+			return plan
+
 		#get addresses filter if any
 		def get_address_filter_input(self):
 			addresses = []
@@ -61,6 +201,13 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 					addresses.append(address)
 			return addresses
 
+		#get contracts emitting the logs to index if any
+		def get_contract_filter_input(self):
+			contracts = []
+			if 'contracts' in list(self.query):
+				for contract in self.query['contracts']:
+					contracts.append(Web3.toChecksumAddress(contract['address']))
+			return contracts
 
 		#get topics for query events or functions comparing with index_topics generated from abi
 		def get_topics_for_query(self):
@@ -69,10 +216,32 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 				name = to_query['name']
 				for _type in list(self.index_topics):
 					for index_topic in self.index_topics[_type]:
-						if index_topic['name'] == name:
+						if index_topic['name'] == name and index_topic['topic'] not in topics:
 							topics.append(index_topic['topic'])
 			return topics
 
+		#topics and contracts filter sent to the node with eth_getLogs/eth_newFilter
+		def get_log_filter(self):
+			log_filter = {}
+			if self.node_filter:
+				event_topics = [x['topic'] for x in self.index_topics.get('event', []) if x['topic'] in self.topics]
+				if len(event_topics) > 0:
+					log_filter['topics'] = [event_topics]
+				if len(self.contracts) > 0:
+					log_filter['address'] = self.contracts
+			return log_filter
+
+		#report logs received by this worker and how many were discarded after download
+		def log_stats(self, thread):
+			if time.time() - self.stats_time >= self.stats_interval:
+				self.logger.info(f'{thread} {self.chain_name} LOGS RECEIVED:{self.logs_received} DROPPED:{self.logs_dropped} NODE_FILTER:{self.node_filter}')
+				self.logger.info(f'{thread} {self.chain_name} TOKEN CACHE {" ".join(f"{k.upper()}:{v}" for k, v in self.token_cache.stats().items())}')
+				self.logger.info(f'{thread} {self.chain_name} TX CACHE {" ".join(f"{k.upper()}:{v}" for k, v in self.transactions.stats().items())}')
+				self.logger.info(f'{thread} {self.chain_name} RPC POOL {" ".join(f"{k.upper()}:{v}" for k, v in self.rpc.pool.stats().items())}')
+				if self.dedup is not None:
+					self.logger.info(f'{thread} {self.chain_name} DEDUP MEMORY {" ".join(f"{k.upper()}:{v}" for k, v in self.dedup.memory().items())}')
+				self.stats_time = time.time()
+
 		#load index topics from file
 		def load_index_topics(self):
 			index_topics_path = os.getcwd()+'/index_topics.yaml'
@@ -103,65 +272,6 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 					if entry['name'] == self.chain_name: 
 						return entry
 
-<<<<<<< HEAD
-		#event topic for web3 filter
-		def get_event_topic(self):
-			event_type = os.environ.get('EVENT_TYPE')
-			for event in self.index_topics['event']:
-				if event['name'] == event_type:
-					return event['topic']
-
-
-=======
->>>>>>> parent of aac4b23 (super fast)
-		#get token details from address
-		def get_token_data(self, w3, address, abi):
-			if self.redis_cache.exists('CoinCache-' + address):
-				return json.loads(pickle.loads(self.redis_cache.hgetall('CoinCache-' + address)))
-			else:
-				contract = w3.eth.contract(address=Web3.toChecksumAddress(address),abi=abi)
-				name = None
-				symbol = None
-				decimals = None
-				try:
-					name = contract.functions.name().call()
-				except Exception as e:
-					pass
-				try:
-					symbol = contract.functions.symbol().call()
-				except Exception as e:
-					pass
-				try:
-					decimals = contract.functions.decimals().call()
-				except Exception as e:
-					pass
-				data =	{
-				"name": str(name) if name else None,
-				"symbol": str(symbol) if symbol else None,
-				"decimals": int(decimals) if decimals else None
-				}
-				self.redis_cache.delete('CoinCache-' + address)
-				self.redis_cache.hmset('CoinCache-' + address, pickle.dumps(pickle.PickleBuffer(json.dumps(data,sort_keys=True,ensure_ascii=True).encode('UTF-8')), protocol=5))
-				return d
-
-		#get pair details from contract address
-		def get_tokens_from_caddress(self, w3, contract_address, abi):
-			if self.redis_cache.exists('TokenCache-' + contract_address):
-				return json.loads(pickle.loads(self.redis_cache.hgetall('TokenCache-' + contract_address)))
-			else:
-				contract = w3.eth.contract(address=Web3.toChecksumAddress(contract_address),abi=abi)
-				token0_address = contract.functions.token0().call()
-				token1_address = contract.functions.token1().call()
-				token0 = self.get_token_data(w3, token0_address,abi)
-				token1 = self.get_token_data(w3, token1_address,abi)
-				data = {
-				'token0': token0,
-				'token1': token1
-				}
-				self.redis_cache.delete('TokenCache-' + contract_address)
-				self.redis_cache.hmset('TokenCache-' + contract_address, pickle.dumps(pickle.PickleBuffer(json.dumps(data,sort_keys=True,ensure_ascii=True).encode('UTF-8')), protocol=5))
-				return data
-
 		def get_address_filter(self, xquery_event):
 			for address in self.address:
 				for key, item in xquery_event.items():
@@ -170,50 +280,55 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 			return None
 
 
-		def get_function(self, thread, w3, event_name, tx, contract_address, abi):
+		#decode the transaction input against the selectors of all loaded abis
+		def decode_function(self, transaction):
 			function = {}
-			transaction = w3.eth.get_transaction(tx)
 			try:
-				pb = contract_address.encode('UTF-8') + json.dumps(abi,sort_keys=True,ensure_ascii=True).encode('UTF-8')
-				if self.redis_cache.exists('FunctionCache-' + pb):
-					contract_router = pickle.loads(self.redis_cache.get('FunctionCache-' + pb))
-				else:
-					contract_router = w3.eth.contract(address=Web3.toChecksumAddress(contract_address), abi=abi)
-					self.redis_cache.delete('FunctionCache-' + pb)
-					self.redis_cache.set('FunctionCache-' + pb, pickle.dumps(contract_router))
-
-				decoded_input = contract_router.decode_function_input(transaction.input)
-				func = decoded_input[0]
-				func_data = decoded_input[1]
-				function["fn_name"] = func.__dict__['fn_name']
-				for k, v in func_data.items():
-					if not isinstance(v, list):
-						function[k] = str(v)
-					else:
-						function[k] = ','.join(v)
+				decoded_input = self.registry.decode_function(transaction['input'])
+				if decoded_input:
+					fn_name, func_data = decoded_input
+					function["fn_name"] = fn_name
+					for k, v in func_data.items():
+						if not isinstance(v, list):
+							function[k] = str(v)
+						else:
+							function[k] = ','.join(v)
 			except Exception as e:
 				pass
 			return function
 
-		def process_event(self, thread, w3, event, event_name, event_type, contract_address, abi):
+		def get_function(self, thread, event):
+			return self.transactions.get_function(event['blockNumber'], event.transactionHash.hex())
+
+		async def async_get_function(self, arpc, thread, event):
+			return await self.transactions.async_get_function(arpc, event['blockNumber'], event.transactionHash.hex())
+
+		#pair tokens for swaps, token details of the emitting contract otherwise
+		def get_event_tokens(self, xquery_name, contract_address):
+			try:
+				if xquery_name == 'Swap':
+					return self.token_cache.get_pairs([contract_address])[0]
+				return self.token_cache.get_tokens([contract_address])[0]
+			except Exception as e:
+				return None
+
+		async def async_get_event_tokens(self, arpc, xquery_name, contract_address):
+			try:
+				if xquery_name == 'Swap':
+					return (await self.token_cache.async_get_pairs(arpc, [contract_address]))[0]
+				return (await self.token_cache.async_get_tokens(arpc, [contract_address]))[0]
+			except Exception as e:
+				return None
+
+		def process_event(self, thread, event, main_topic):
 			xquery_event = {}
 			try:
-				pb = contract_address.encode('UTF-8') + json.dumps(abi,sort_keys=True,ensure_ascii=True).encode('UTF-8')
-				if self.redis_cache.exists('ContractCache-' + pb):
-					contract = pickle.loads(self.redis_cache.get('ContractCache-' + pb))
-				else:
-					contract = w3.eth.contract(address=Web3.toChecksumAddress(contract_address), abi=abi)	
-					self.redis_cache.delete('ContractCache-' + pb)
-					self.redis_cache.set('ContractCache-' + pb, pickle.dumps(contract))			
-				contract_call = getattr(contract,f'{event_type.lower()}s')
-				action_call = getattr(contract_call,event_name.lower().capitalize())
-				xquery_event = action_call().processLog(event)
-				xquery_event = json.loads(Web3.toJSON(xquery_event))
+				xquery_event = self.registry.decode_event(main_topic, event)
 			except Exception as e:
 				pass
 			return xquery_event
 
-		def process_event_args(self, thread, w3, xquery_name, xquery_event, contract_address, abi):
+		def process_event_args(self, thread, xquery_name, xquery_event, tokens):
 			args = {}
 			try:
 				for arg in list(xquery_event['args']):
@@ -223,7 +338,6 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 				pass
 			try:
 				if xquery_name == 'Swap':
-					tokens = self.get_tokens_from_caddress(w3, xquery_event['address'], self.rc_abi['abi'])
 					for key, item in tokens.items():
 						for key1, item1 in item.items():
 							args[f'{key}_{key1}'] = item1
@@ -233,10 +347,9 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 					elif args['amount1Out'] == 0:
 						args['side'] = 'buy'				
 				else:
-					token_data = self.get_token_data(w3, contract_address, self.rc_abi['abi'])
-					args['token0_name'] = token_data['name']
-					args['token0_symbol'] = token_data['symbol']
-					args['token0_decimals'] = token_data['decimals']
+					args['token0_name'] = tokens['name']
+					args['token0_symbol'] = tokens['symbol']
+					args['token0_decimals'] = tokens['decimals']
 			except Exception as e:
 				pass
 			return args
@@ -252,19 +365,26 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 			while self.running and self.errors < 2:
 				if not self.lock_forward:
 					try:
-						self.logger.info(f'{thread} {self.chain_name} {self.current_block_forward} FORWARD')
-						forward_filter = self.web2.eth.filter({
-							'fromBlock': hex(self.current_block_forward-1),
-							'toBlock': hex(self.current_block_forward)
-						})
-						for event in forward_filter.get_all_entries():
-							self.event_queue.put(event)
-						self.web2.eth.uninstall_filter(forward_filter.filter_id)
-						self.lock_forward = True
+						if self.current_block_forward <= self.latest_block:
+							self.logger.info(f'{thread} {self.chain_name} {self.current_block_forward} FORWARD')
+							#stateless getLogs, a filter installed on one pool endpoint is unknown to the others
+							events = self.web2.eth.get_logs({
+								**self.log_filter,
+								'fromBlock': hex(self.current_block_forward),
+								'toBlock': hex(self.current_block_forward)
+							})
+							if len(events) > 0:
+								self.blocks.prefetch([self.current_block_forward])
+							for event in events:
+								self.event_queue.put(event)
+							self.event_queue.flush()
+							self.archive_logs(events)
+							self.lock_forward = True
+							self.current_block_forward = self.current_block_forward + 1
+							self.checkpoint('forwardblock_progress', self.current_block_forward)
+							self.lock_forward = False
+							observe_cursor('forward', self.current_block_forward, self.latest_block)
 						self.get_latest_block()
-						self.current_block_forward = self.current_block_forward + 1 if self.current_block_forward < self.latest_block else self.latest_block
-						self.redis_cache.set('forwardblock_progress', self.current_block_forward)
-						self.lock_forward = False
 						time.sleep(0.01)
 					except ValueError as e:
 						self.logger.critical('ValueError in Listener loop!',exc_info=True)
@@ -274,153 +394,475 @@ def start_process(zmq_queue, event_queue, CHAIN_HOST, event_type):
 						if self.errors > 2:
 							self.running = False
 
+		#push-based forward listener: logs and heads arrive over a websocket subscription,
+		#blocks missed before or between connections are fetched from the checkpoint with eth_getLogs
+		def ws_forward_loop(self, thread):
+			asyncio.run(self.ws_forward_main(thread))
+
+		async def ws_forward_main(self, thread):
+			self.logger.info(f'{thread} Starting websocket forward listener...')
+			loop = asyncio.get_running_loop()
+			while self.running:
+				try:
+					async with LogSubscription(self.ws_host, self.log_filter) as subscription:
+						self.logger.info(f'{thread} {self.chain_name} subscribed to logs and newHeads from {self.current_block_forward}')
+						await self.ws_follow(thread, loop, subscription)
+				except Exception as e:
+					self.logger.critical(f'{thread} Websocket forward listener disconnected, reconnecting in {self.ws_reconnect_delay}s: {e}')
+					await asyncio.sleep(self.ws_reconnect_delay)
+
+		#buffer pushed logs by block and publish up to the latest head once late logs had WS_LOG_GRACE to arrive
+		async def ws_follow(self, thread, loop, subscription):
+			logs = {}
+			covered = None
+			head = None
+			deadline = None
+			while self.running:
+				timeout = self.ws_head_timeout if deadline is None else max(0, deadline - time.time())
+				try:
+					kind, result = await subscription.recv(timeout)
+				except asyncio.TimeoutError:
+					if deadline is None:
+						raise ConnectionError(f'no notification for {self.ws_head_timeout}s')
+					await self.ws_publish(thread, loop, logs, covered, head)
+					deadline = None
+					continue
+				if kind == 'log':
+					number = int(result['blockNumber'], 16)
+					key = (result['blockHash'], result['logIndex'])
+					if result.get('removed'):
+						logs.get(number, {}).pop(key, None)
+					else:
+						logs.setdefault(number, {})[key] = result
+				elif kind == 'head':
+					head = int(result['number'], 16)
+					HEAD.set(head)
+					self.blocks.store({head: int(result['timestamp'], 16)})
+					#the first announced block may predate the logs subscription
+					if covered is None:
+						covered = head + 1
+					if deadline is None:
+						deadline = time.time() + self.ws_log_grace
+
+		async def ws_publish(self, thread, loop, logs, covered, head):
+			if self.current_block_forward < covered:
+				await loop.run_in_executor(None, self.forward_catchup, thread, min(covered - 1, head))
+			while self.current_block_forward <= head:
+				number = self.current_block_forward
+				events = [AttributeDict(log_entry_formatter(x)) for x in sorted(logs.pop(number, {}).values(), key=lambda x: int(x['logIndex'], 16))]
+				self.logger.info(f'{thread} {self.chain_name} {number} FORWARD WS')
+				for event in events:
+					self.event_queue.put(event)
+				self.event_queue.flush()
+				self.archive_logs(events)
+				self.current_block_forward = number + 1
+				self.checkpoint('forwardblock_progress', self.current_block_forward)
+				observe_cursor('forward', self.current_block_forward, head)
+			for number in [x for x in logs if x < self.current_block_forward]:
+				del logs[number]
+
+		#fetch the blocks from the checkpoint up to the given block in backfill sized windows
+		def forward_catchup(self, thread, to_block):
+			while self.current_block_forward <= to_block:
+				end = min(to_block, self.current_block_forward + self.back_window - 1)
+				self.logger.info(f'{thread} {self.chain_name} {self.current_block_forward}-{end} FORWARD CATCHUP')
+				events = self.web2.eth.get_logs({
+					**self.log_filter,
+					'fromBlock': hex(self.current_block_forward),
+					'toBlock': hex(end)
+				})
+				self.blocks.prefetch(list({x['blockNumber'] for x in events}))
+				for event in events:
+					self.event_queue.put(event)
+				self.event_queue.flush()
+				self.archive_logs(events)
+				self.current_block_forward = end + 1
+				self.checkpoint('forwardblock_progress', self.current_block_forward)
+				observe_cursor('forward', self.current_block_forward, to_block)
+
+		#check if the provider rejected a getLogs call because the block range was too wide;
+		#throttling and timeouts are not range errors, a smaller window would not help
+		def is_range_error(self, e):
+			message = str(e).lower()
+			if any(x in message for x in ['rate limit', 'too many requests', '429', 'timed out', 'timeout']):
+				return False
+			return any(x in message for x in ['query returned more than', 'block range', 'range is too large', 'range too large', 'range limit', 'response size exceeded', 'log response size', '-32005'])
+
+		#grow or shrink the backfill window from the size of the last result
+		def resize_back_window(self, logs):
+			if logs > self.back_target_logs:
+				self.back_window = max(self.back_window_min, self.back_window // 2)
+			elif logs < self.back_target_logs // 2:
+				self.back_window = min(self.back_window_max, self.back_window * 2)
+
 		def back_loop(self, thread):
-			self.logger.info(f'{thread} Starting back listener...')
+			self.logger.info(f'{thread} Starting back listener shard {self.shard} {self.shard_from}-{self.shard_to}...')
 			while self.back_running and self.errors < 2:
-				if not self.lock_backward:
-					try:
-						if self.start_block != 'None':
-							#if self.current_block>self.start_block:
-							if self.current_block<self.latest_block:
-								self.logger.info(f'{thread} {self.chain_name} {self.current_block} BACKWARD')
-								backward_filter = self.web2.eth.filter({
-<<<<<<< HEAD
-										#'fromBlock': hex(int(self.current_block)-1),
-										#'toBlock': hex(int(self.current_block)),
-										'fromBlock': hex(int(self.current_block)),
- 										'toBlock': hex(int(self.current_block)+1),
-										'topics': [self.event_type]
-=======
-										'fromBlock': hex(int(self.current_block)-1),
-										'toBlock': hex(int(self.current_block))
->>>>>>> parent of aac4b23 (super fast)
-									})
-								for event in backward_filter.get_all_entries():
-									self.event_queue.put(event)
-								self.web2.eth.uninstall_filter(backward_filter.filter_id)
-								self.lock_backward = True
-								#self.current_block = self.current_block - 1 if self.current_block > self.start_block else self.start_block
-								self.current_block = self.current_block + 1 if self.current_block < self.latest_block else self.latest_block
-								self.redis_cache.set('backblock_progress', self.current_block)
-								self.lock_backward = False
-						else:
-							self.back_running = False
-						time.sleep(0.01)
-					except ValueError as e:
-						self.logger.critical('ValueError in Back Listener loop!',exc_info=True)
-					except Exception as e:
-						self.logger.critical('Exception in Back Listener loop!',exc_info=True)
-						self.errors += 0.2
-						if self.errors > 2:
-							self.back_running = False
+				try:
+					if self.start_block == 'None':
+						self.back_running = False
+					elif self.current_block < self.shard_to:
+						#blocks between the ranges of a shard belong to other shards or are done already
+						block_from, block_to = next(x for x in self.shard_ranges if self.current_block < x[1])
+						self.current_block = max(self.current_block, block_from)
+						to_block = min(self.current_block + self.back_window - 1, block_to - 1)
+						self.logger.info(f'{thread} {self.chain_name} {self.current_block}-{to_block} BACKWARD SHARD {self.shard}')
+						try:
+							events = self.web2.eth.get_logs({
+								**self.log_filter,
+								'fromBlock': hex(self.current_block),
+								'toBlock': hex(to_block)
+							})
+						except (ValueError, requests.exceptions.RequestException) as e:
+							if self.is_range_error(e) and self.back_window > self.back_window_min:
+								self.back_window = max(self.back_window_min, self.back_window // 2)
+								self.logger.info(f'{thread} {self.chain_name} range rejected, backfill window {self.back_window}')
+								continue
+							#a range rejected at the minimum window, throttling or a timeout: the same window is
+							#retried after BACKFILL_RETRY_DELAY and counted as an error
+							time.sleep(self.back_retry_delay)
+							raise RuntimeError(f'getLogs {self.current_block}-{to_block} failed') from e
+						#headers of the blocks holding logs are loaded before the logs reach the workers
+						self.blocks.prefetch([event['blockNumber'] for event in events])
+						for event in events:
+							self.event_queue.put(event)
+						self.event_queue.flush()
+						self.archive_logs(events)
+						self.resize_back_window(len(events))
+						self.current_block = to_block + 1
+						self.checkpoint(f'backblock_progress-{self.shard}', self.current_block)
+						observe_cursor(f'backward-{self.shard}', self.current_block, self.shard_to)
+					else:
+						self.logger.info(f'{thread} {self.chain_name} {self.current_block} BACKWARD SHARD {self.shard} COMPLETE')
+						self.back_running = False
+				except ValueError as e:
+					self.logger.critical('ValueError in Back Listener loop!',exc_info=True)
+				except Exception as e:
+					self.logger.critical('Exception in Back Listener loop!',exc_info=True)
+					self.errors += 0.2
+					if self.errors > 2:
+						self.back_running = False
+
+		def archive_logs(self, events):
+			if self.archive:
+				self.archive.add_logs(events)
+
+		#a checkpoint moves past archived logs only once they are written
+		def checkpoint(self, key, value):
+			if self.archive:
+				self.archive.checkpoint(lambda: self.redis_cache.set(key, value))
+			else:
+				self.redis_cache.set(key, value)
+
+		#replay listener: archived logs are fed to the workers at disk speed with their block timestamps loaded first
+		def replay_loop(self, thread):
+			from_block = int(os.environ.get('REPLAY_FROM', 0))
+			to_block = int(os.environ.get('REPLAY_TO', 2**62))
+			self.logger.info(f'{thread} Starting archive replay {from_block}-{to_block}...')
+			for segment in self.archive.segments('logs', from_block, to_block):
+				if not self.running:
+					return
+				self.blocks.store(self.archive.timestamps(segment, from_block, to_block))
+				logs = 0
+				for event in self.archive.logs(segment, from_block, to_block):
+					self.event_queue.put(event)
+					logs += 1
+				self.event_queue.flush()
+				self.logger.info(f'{thread} {self.chain_name} {segment} REPLAY {logs} logs')
+			self.logger.info(f'{thread} {self.chain_name} REPLAY COMPLETE')
+
+		#topic and dedup checks; returns (main_topic, registry entry) for logs to index
+		#a retried event passed the dedup on its first attempt
+		def accept_event(self, thread, event, attempt=0):
+			event_topics = event['topics']
+			main_topic = [x.hex() for x in event_topics][0] if len(event_topics)>0 else None
+			self.logs_received += 1
+			if main_topic not in self.topics:
+				self.logs_dropped += 1
+			self.log_stats(thread)
+
+			decoder = self.registry.get_event(main_topic)
+			if main_topic in self.topics and decoder and (attempt > 0 or self.dedup is None or self.dedup.check_and_set(event['blockNumber'], event['blockHash'].hex(), event['logIndex'])):
+				return main_topic, decoder
+			return None
+
+		#assemble the decoded log with its block, token and transaction data and queue it for the gateway
+		def publish_event(self, thread, event, decoder, xquery_event, timestamp, tokens, function):
+			tx = event.transactionHash.hex()
+			xquery_name = decoder['name']
+
+			xquery_event['chain_name'] = self.chain_name.split('_')[0]
+			xquery_event['query_name'] = xquery_name
+			xquery_event['tx_hash'] = tx
+			xquery_event['timestamp'] = timestamp
+			xquery_event['blocknumber'] = int(event['blockNumber'])
+
+			#process args
+			args = self.process_event_args(thread, xquery_name, xquery_event, tokens)
+			for k, v in args.items():
+				xquery_event[f'{k}'] = v
+
+			#check address filter
+			address_filter = self.get_address_filter(xquery_event)
+			if address_filter:
+				xquery_event['address_filter'] = address_filter['name']
+
+			#get function
+			for k, v in function.items():
+				xquery_event[f'{k}'] = v
+
+			#add to db only if event belongs to a router
+			if 'address_filter' in list(xquery_event):
+				xquery_event['xhash'] = hashlib.sha256(json.dumps(xquery_event, sort_keys=False, ensure_ascii=True).encode('UTF-8')).hexdigest()
+				self.logger.info(f"{thread} SUCCESS QUERY:{xquery_name} XHASH:{xquery_event['xhash']} TX:{tx}")
+				self.zmq_queue.put([xquery_event])
+
+		#stage metrics and bench trace of a handled event
+		def event_done(self, received, xquery_event):
+			STAGE_LATENCY.labels('total').observe(time.time() - received)
+			if 'xhash' in xquery_event:
+				EVENTS.labels('published').inc()
+				self.trace.stamp(xquery_event['xhash'], received=received, published=time.time())
+			else:
+				EVENTS.labels('unrouted').inc()
+
+		#an event without its block timestamp is scheduled again instead of dropped, it already holds its dedup mark
+		def retry_event(self, thread, event, attempt, error):
+			if attempt >= self.block_retries:
+				EVENTS.labels('error').inc()
+				self.logger.critical(f"{thread} No timestamp for block {event['blockNumber']} after {attempt + 1} attempts: {error}")
+				return
+			EVENTS.labels('retried').inc()
+			self.logger.info(f"{thread} No timestamp for block {event['blockNumber']} yet, retry {attempt + 1}: {error}")
+			self.retry_events.append((time.time() + self.block_retry_delay, attempt + 1, event))
+
+		#(attempt, event) of the oldest retry once it is due
+		def due_retry(self):
+			try:
+				if self.retry_events[0][0] <= time.time():
+					due, attempt, event = self.retry_events.popleft()
+					return attempt, event
+			except IndexError as e:
+				pass
+			return None
+
+		def handle_event(self, thread, event, attempt=0):
+			received = time.time()
+			#a failing accept loses only its event, never the worker
+			try:
+				accepted = self.accept_event(thread, event, attempt)
+			except Exception as e:
+				EVENTS.labels('error').inc()
+				self.logger.critical(f"Exception Worker {thread} accepting TX: {event.transactionHash.hex()}",exc_info=True)
+				return
+			STAGE_LATENCY.labels('accept').observe(time.time() - received)
+			if accepted is None:
+				EVENTS.labels('rejected').inc()
+				return
+			main_topic, decoder = accepted
+			try:
+				timestamp = self.blocks.get_timestamp(event['blockNumber'])
+			except Exception as e:
+				self.retry_event(thread, event, attempt, e)
+				return
+			try:
+				started = time.time()
+				xquery_event = self.process_event(thread, event, main_topic)
+				STAGE_LATENCY.labels('decode').observe(time.time() - started)
+				started = time.time()
+				tokens = self.get_event_tokens(decoder['name'], event['address'])
+				function = self.get_function(thread, event)
+				STAGE_LATENCY.labels('enrich').observe(time.time() - started)
+				self.publish_event(thread, event, decoder, xquery_event, timestamp, tokens, function)
+				self.event_done(received, xquery_event)
+			except Exception as e:
+				EVENTS.labels('error').inc()
+				self.logger.critical(f"Exception Worker {thread} Type: {decoder['type']} Name: {decoder['name']} TX: {event.transactionHash.hex()}",exc_info=True)
+
+		#same steps as handle_event with the block, token and transaction lookups awaited concurrently;
+		#the redis dedup check runs in the default executor so it never blocks the event loop
+		async def async_handle_event(self, thread, arpc, event, attempt=0):
+			received = time.time()
+			try:
+				accepted = await asyncio.get_running_loop().run_in_executor(None, self.accept_event, thread, event, attempt)
+			except Exception as e:
+				EVENTS.labels('error').inc()
+				self.logger.critical(f"Exception Worker {thread} accepting TX: {event.transactionHash.hex()}",exc_info=True)
+				return
+			STAGE_LATENCY.labels('accept').observe(time.time() - received)
+			if accepted is None:
+				EVENTS.labels('rejected').inc()
+				return
+			main_topic, decoder = accepted
+			started = time.time()
+			xquery_event = self.process_event(thread, event, main_topic)
+			STAGE_LATENCY.labels('decode').observe(time.time() - started)
+			started = time.time()
+			timestamp, tokens, function = await asyncio.gather(
+				self.blocks.async_get_timestamp(arpc, event['blockNumber']),
+				self.async_get_event_tokens(arpc, decoder['name'], event['address']),
+				self.async_get_function(arpc, thread, event),
+				return_exceptions=True)
+			STAGE_LATENCY.labels('enrich').observe(time.time() - started)
+			if isinstance(timestamp, Exception):
+				self.retry_event(thread, event, attempt, timestamp)
+				return
+			try:
+				if isinstance(function, Exception):
+					raise function
+				self.publish_event(thread, event, decoder, xquery_event, timestamp, tokens, function)
+				self.event_done(received, xquery_event)
+			except Exception as e:
+				EVENTS.labels('error').inc()
+				self.logger.critical(f"Exception Worker {thread} Type: {decoder['type']} Name: {decoder['name']} TX: {event.transactionHash.hex()}",exc_info=True)
+
+		#processors stop taking events from the channel and finish the ones they already hold,
+		#listeners finish the range in hand
+		def stop(self):
+			self.running = False
+			self.back_running = False
+			if hasattr(self.event_queue, 'close'):
+				self.event_queue.close()
 
 		def queue_handler(self, thread):
 			self.logger.info('Starting Worker: {}'.format(thread))
 
-			while self.running:
+			while True:
+				retry = self.due_retry()
+				if retry is not None:
+					self.handle_event(thread, retry[1], retry[0])
+					continue
 				try:
-					event = self.event_queue.get()
-					tx = event.transactionHash.hex()
-					address = event['address']
-					event_topics = event['topics']
-					main_topic = [x.hex() for x in event_topics][0] if len(event_topics)>0 else None
-					event_hash = hashlib.sha256(json.dumps(Web3.toJSON(event), sort_keys=True, ensure_ascii=True).encode('UTF-8')).hexdigest()
-
-					if main_topic in self.topics and self.redis_cache.exists('EventCache-' + event_hash) == 0:
-						while self.lock_queue==True:
-							time.sleep(1)
-						self.lock_queue = True
-						self.redis_cache.delete('EventCache-' + event_hash)
-						self.redis_cache.set('EventCache-' + event_hash, 1)
-						self.lock_queue = False
-						xquery_type = [_type for _type in list(self.index_topics) for index_topic in self.index_topics[_type] if index_topic['topic'] == main_topic][0]
-						xquery_name = [index_topic['name'] for _type in list(self.index_topics) for index_topic in self.index_topics[_type] if index_topic['topic'] == main_topic][0]
-
-						blockNumber = event['blockNumber']
-
-						retries = 0
-						while self.redis_cache.hget("Block-" + str(blockNumber), "timestamp"):
-							try:
-								timestamp = self.web4.eth.getBlock(blockNumber)
-								if 'timestamp' in timestamp:
-									self.redis_cache.hmset("Block-" + str(blockNumber), timestamp)
-
-							except Exception as e:
-								pass
-
-							if retries > 10:
-								break
-
-							retries += 1
-							time.sleep(0.01)
-						if retries > 10:
-							continue
-
-						
-						timestamp = self.redis_cache.hget("Block-" + str(blockNumber), "timestamp")
-
-						try:
-							#process event
-							xquery_event = self.process_event(thread, self.web4, event, xquery_name, xquery_type, address, self.rc_abi['abi'])
-
-							xquery_event['chain_name'] = self.chain_name.split('_')[0]
-							xquery_event['query_name'] = xquery_name
-							xquery_event['tx_hash'] = tx
-							xquery_event['timestamp'] = timestamp
-							xquery_event['blocknumber'] = int(blockNumber)
-						
-							#process args
-							args = self.process_event_args(thread, self.web4, xquery_name, xquery_event, address, self.rc_abi['abi'])
-							for k, v in args.items():
-								xquery_event[f'{k}'] = v
-
-							#check address filter
-							address_filter = self.get_address_filter(xquery_event)
-							if address_filter:
-								xquery_event['address_filter'] = address_filter['name']
-
-							#get function
-							function = self.get_function(thread, self.web4, xquery_name, tx, address, self.abi['abi'])
-							if len(list(function)) == 0:
-								function = self.get_function(thread, self.web4, xquery_name, tx, address, self.rc_abi['abi'])
-								if len(list(function)) == 0 and address_filter!=None:
-									function = self.get_function(thread, self.web4, xquery_name, tx, address_filter['address'], self.abi['abi'])
-							for k, v in function.items():
-								xquery_event[f'{k}'] = v
-
-							#add to db only if event belongs to a router
-							if 'address_filter' in list(xquery_event):
-								xquery_event['xhash'] = hashlib.sha256(json.dumps(xquery_event, sort_keys=False, ensure_ascii=True).encode('UTF-8')).hexdigest()
-								self.logger.info(f"{thread} SUCCESS QUERY:{xquery_name} XHASH:{xquery_event['xhash']} TX:{tx}")
-								self.zmq_queue.put([xquery_event])
-						except Exception as e:
-							self.logger.critical(f"Exception Worker {thread} Type: {xquery_type} Name: {xquery_name} TX: {tx}",exc_info=True)
-					self.event_queue.task_done()
+					event = self.event_queue.get(timeout=1)
+				except Empty:
+					if self.running:
+						continue
+					if len(self.retry_events) > 0:
+						time.sleep(0.1)
+						continue
+					break
 				except Exception as e:
 					self.logger.critical(f'Exception in worker: {thread}',exc_info=True)
-
-					self.running = False
+					self.stop()
+					self.errors += 1
+					break
+				self.handle_event(thread, event)
+				self.event_queue.task_done()
+
+		#asyncio engine: one process runs ASYNC_CONCURRENCY enrichment tasks fed through a bounded pipeline
+		def async_handler(self, thread, arpc):
+			asyncio.run(self.async_main(thread, arpc))
+
+		async def async_main(self, thread, arpc):
+			concurrency = int(os.environ.get('ASYNC_CONCURRENCY', 200))
+			self.logger.info(f'Starting async worker: {thread} concurrency {concurrency}')
+			await arpc.start()
+			pipeline = asyncio.Queue(maxsize=int(os.environ.get('ASYNC_QUEUE_SIZE', 1000)))
+			workers = [asyncio.ensure_future(self.async_worker(f'{thread}-{i}', arpc, pipeline)) for i in range(0, concurrency)]
+			loop = asyncio.get_running_loop()
+			reader = ThreadPoolExecutor(max_workers=1)
+			while True:
+				retry = self.due_retry()
+				if retry is not None:
+					await pipeline.put(retry)
+					continue
+				try:
+					event = await loop.run_in_executor(reader, self.event_queue.get, 1)
+				except Empty:
+					if self.running:
+						continue
+					#events in flight may still schedule retries
+					await pipeline.join()
+					if len(self.retry_events) > 0:
+						await asyncio.sleep(0.1)
+						continue
+					break
+				except Exception as e:
+					self.logger.critical(f'Exception in async worker: {thread}',exc_info=True)
+					self.stop()
 					self.errors += 1
+					break
+				await pipeline.put((0, event))
+				self.event_queue.task_done()
+			await pipeline.join()
+			for worker in workers:
+				worker.cancel()
+			await arpc.close()
+
+		async def async_worker(self, thread, arpc, pipeline):
+			while True:
+				attempt, event = await pipeline.get()
+				try:
+					await self.async_handle_event(thread, arpc, event, attempt)
+				except Exception as e:
+					self.logger.critical(f'Exception in async task: {thread}',exc_info=True)
+				pipeline.task_done()
 
 	adapter = requests.adapters.HTTPAdapter(pool_connections=30, pool_maxsize=30)
 	session = requests.Session()
 	session.mount('http://', adapter)
 	session.mount('https://', adapter)
 
-	w2 = Web3(Web3.HTTPProvider(f'{CHAIN_HOST}', session=session, request_kwargs={'timeout': 60}))
+	#CHAIN_HOST is a comma separated list of endpoints shared by every client of this process
+	pool = RPCPool(CHAIN_HOST.split(','),
+		rate=float(os.environ.get('RPC_RATE', 0)),
+		hedge_after=float(os.environ.get('RPC_HEDGE_AFTER', 1.0)))
+	timeout = int(os.environ.get('RPC_TIMEOUT', 60))
+
+	w2 = Web3(PoolProvider(pool, session, timeout=timeout))
 	w2.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-	w3 = Web3(Web3.HTTPProvider(f'{CHAIN_HOST}', session=session, request_kwargs={'timeout': 60}))
+	w3 = Web3(PoolProvider(pool, session, timeout=timeout))
 	w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-	w4 = Web3(Web3.HTTPProvider(f'{CHAIN_HOST}', session=session, request_kwargs={'timeout': 60}))
+	w4 = Web3(PoolProvider(pool, session, timeout=timeout))
 	w4.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-	event_handler = EventHandler(w2, w3, w4, zmq_queue, event_queue)
-
-	if event_type == 'forward':
-		event_handler.forward_loop(os.getpid())
-	elif event_type == 'backward':
-		event_handler.back_loop(os.getpid())
-	elif event_type == 'process':
-		event_handler.queue_handler(os.getpid())
+	rpc = BatchRPC(pool, session,
+		batch_size=int(os.environ.get('RPC_BATCH_SIZE', 50)),
+		deadline=float(os.environ.get('RPC_BATCH_DEADLINE', 0.01)),
+		timeout=timeout)
+
+	#listeners only produce to their channel, processors consume it
+	if event_type in ['forward', 'backward']:
+		event_queue = event_queue.sender()
+	else:
+		event_queue = event_queue.receiver()
+
+	event_handler = EventHandler(w2, w3, w4, rpc, zmq_queue.sender(), event_queue, shard)
+	#the supervisor scales processors down and stops every process on shutdown with SIGTERM
+	signal.signal(signal.SIGTERM, lambda signum, frame: event_handler.stop())
+
+	try:
+		if event_type == 'replay':
+			event_handler.replay_loop(os.getpid())
+		elif event_type == 'forward' and os.environ.get('FORWARD_MODE', 'poll') == 'ws':
+			event_handler.ws_forward_loop(os.getpid())
+		elif event_type == 'forward':
+			event_handler.forward_loop(os.getpid())
+		elif event_type == 'backward':
+			event_handler.back_loop(os.getpid())
+		elif event_type == 'process' and os.environ.get('ENGINE', 'multiprocessing') == 'asyncio':
+			arpc = AsyncBatchRPC(pool,
+				batch_size=int(os.environ.get('RPC_BATCH_SIZE', 50)),
+				deadline=float(os.environ.get('RPC_BATCH_DEADLINE', 0.01)),
+				connections=int(os.environ.get('ASYNC_CONNECTIONS', 100)),
+				timeout=timeout)
+			event_handler.async_handler(os.getpid(), arpc)
+		elif event_type == 'process':
+			#worker threads share the batch rpc client so their lookups go out in the same batches
+			workers = []
+			for i in range(0, int(os.environ.get('WORKER_THREADS', 20))):
+				worker = Thread(target=event_handler.queue_handler, args=(f'{os.getpid()}-{i}',))
+				worker.start()
+				workers.append(worker)
+			for worker in workers:
+				worker.join()
+	finally:
+		#archived rows still buffered when a listener completes or the process is stopped
+		if event_handler.archive:
+			event_handler.archive.flush()
+
+	#a process that gave up on errors exits non-zero so the supervisor restarts it
+	if event_handler.errors >= 2:
+		sys.exit(1)
@@ -1,14 +1,23 @@
 import os
 import time
+import shutil
 import logging
 import requests
 import sys
-from multiprocessing import Manager
-from multiprocessing import Process
+import signal
+
+#metric files of every process are shared through this directory; it must be set before prometheus_client is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/xquery-metrics')
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
 from multiprocessing_logging import install_mp_handler
 from eventhandler import start_process
 from utils.zmq import start_zmq
 from utils.liveness import *
+from utils.transport import Channel
+from utils.metrics import start_metrics
+from utils.supervisor import Supervisor
 
 #configure logging
 logging.basicConfig(
@@ -18,10 +27,14 @@ logging.basicConfig(
 )
 install_mp_handler()
 
-m = Manager()
-event_queue = m.Queue()
-backevent_queue = m.Queue()
-zmq_queue = m.Queue()
+TRANSPORT_BATCH = int(os.environ.get('TRANSPORT_BATCH', 100))
+TRANSPORT_FLUSH = float(os.environ.get('TRANSPORT_FLUSH', 0.05))
+TRANSPORT_CAPACITY = int(os.environ.get('TRANSPORT_CAPACITY', 10000))
+TRANSPORT_DIR = os.environ.get('TRANSPORT_DIR', '/tmp')
+
+event_queue = Channel('events', TRANSPORT_BATCH, TRANSPORT_FLUSH, TRANSPORT_CAPACITY, TRANSPORT_DIR)
+backevent_queue = Channel('backevents', TRANSPORT_BATCH, TRANSPORT_FLUSH, TRANSPORT_CAPACITY, TRANSPORT_DIR)
+zmq_queue = Channel('zmq', TRANSPORT_BATCH, TRANSPORT_FLUSH, TRANSPORT_CAPACITY, TRANSPORT_DIR)
 
 def main():
 	logger = logging.getLogger('main.py')
@@ -29,18 +42,26 @@ def main():
 	logger.info('Initializing global_vars...')
 
 	CHAIN_HOST = os.environ.get('CHAIN_HOST', 'https://api.avax.network/ext/bc/C/rpc')
-	WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 20))
+	BACKWARD_SHARDS = int(os.environ.get('BACKWARD_SHARDS', 1))
+	ENGINE = os.environ.get('ENGINE', 'multiprocessing')
+	ARCHIVE_REPLAY = os.environ.get('ARCHIVE_REPLAY', 'false').lower() in ['true', '1']
 
 	CHAIN_NAME = os.environ.get('NAME', 'ETH')
+
+	for channel in [event_queue, backevent_queue, zmq_queue]:
+		channel.start()
+	start_metrics(int(os.environ.get('METRICS_PORT', 9100)), [event_queue, backevent_queue, zmq_queue])
 	
 	while True:
 		try:
+			#live as soon as one endpoint of the pool is
+			hosts = [x.split('#')[0] for x in CHAIN_HOST.split(',')]
 			if 'ETH' in CHAIN_NAME:
-				live = eth_live(CHAIN_HOST)
+				live = any(eth_live(host) for host in hosts)
 			elif 'AVAX' in CHAIN_NAME:
-				live = avax_live(CHAIN_HOST)
+				live = any(avax_live(host) for host in hosts)
 			elif 'SYS' in CHAIN_NAME:
-				live = eth_live(CHAIN_HOST)
+				live = any(eth_live(host) for host in hosts)
 			if live == False:
 				logger.info(f'{CHAIN_NAME} node syncing... Retrying in 30 seconds')
 				time.sleep(30)
@@ -49,48 +70,37 @@ def main():
 
 				logger.info('Starting Loop...')
 
+				#listeners and the zmq forwarder run once, processors are scaled per channel on its backlog
 				cpus = os.cpu_count()
-				# executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpus)
-				processes = []
+				supervisor = Supervisor(interval=float(os.environ.get('SUPERVISOR_INTERVAL', 5)))
 				try:
-					process = Process(target=start_zmq, args=(zmq_queue,))
-					process.daemon = True
-					process.start()
-					processes.append(process)
-					for i in range(0, cpus-1):
-						if i in [0]:
-							process = Process(target=start_process, args=(zmq_queue, event_queue, CHAIN_HOST, 'forward',))
-							process.daemon = True
-							process.start()
-							processes.append(process)
-						elif i in [1]:
-							process = Process(target=start_process, args=(zmq_queue, backevent_queue, CHAIN_HOST, 'backward',))
-							process.daemon = True
-							process.start()
-							processes.append(process)
-						elif i in list(range(int((cpus - 3)/2),int(cpus))):
-							process = Process(target=start_process, args=(zmq_queue, backevent_queue, CHAIN_HOST, 'process',))
-							process.daemon = True
-							process.start()
-							processes.append(process)
-						else:
-							process = Process(target=start_process, args=(zmq_queue, event_queue, CHAIN_HOST, 'process',))
-							process.daemon = True
-							process.start()
-							processes.append(process)
-					while True:
-						time.sleep(0.33)
-
-					for p in processes:
-						p.kill()
+					supervisor.add('zmq', start_zmq, (zmq_queue,), last=True)
+					if ARCHIVE_REPLAY:
+						#a replay reads the archive in place of both listeners
+						supervisor.add('replay', start_process, (zmq_queue, backevent_queue, CHAIN_HOST, 'replay',), restart='failure')
+					else:
+						supervisor.add('forward', start_process, (zmq_queue, event_queue, CHAIN_HOST, 'forward',))
+						for shard in range(0, BACKWARD_SHARDS):
+							supervisor.add(f'backward-{shard}', start_process, (zmq_queue, backevent_queue, CHAIN_HOST, 'backward', shard,), restart='failure')
+					#the asyncio engine runs one event-loop process per queue unless a pool size is set
+					default_max = 1 if ENGINE == 'asyncio' else max(1, cpus - 1)
+					for queue in [event_queue, backevent_queue]:
+						prefix = queue.name.upper()
+						supervisor.add_pool(queue, start_process, (zmq_queue, queue, CHAIN_HOST, 'process',),
+							minimum=int(os.environ.get(f'{prefix}_WORKERS_MIN', os.environ.get('WORKERS_MIN', 1))),
+							maximum=int(os.environ.get(f'{prefix}_WORKERS_MAX', os.environ.get('WORKERS_MAX', default_max))),
+							scale_up_lag=float(os.environ.get('SCALE_UP_LAG', 5)),
+							scale_up_backlog=int(os.environ.get('SCALE_UP_BACKLOG', 1000)),
+							scale_down_lag=float(os.environ.get('SCALE_DOWN_LAG', 1)),
+							scale_down_checks=int(os.environ.get('SCALE_DOWN_CHECKS', 6)))
+					#docker stop sends SIGTERM, which stops the children through the finally below
+					signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+					supervisor.run()
 				except Exception as e:
 					logger.critical("Closing...Exception: ", exc_info=True)
-					for p in processes:
-						p.kill()
 				finally:
 					logger.critical("Closing...")
-					for p in processes:
-						p.kill()
+					supervisor.stop(float(os.environ.get('SUPERVISOR_STOP_TIMEOUT', 10)))
 
 		except Exception as e:
 			logger.critical(f"Something went wrong when calling {CHAIN_NAME} host... Waiting 30 seconds", exc_info=True)
@@ -0,0 +1,230 @@
+import os
+import glob
+import time
+import logging
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from utils.cache import LRUCache
+
+SCHEMAS = {
+	'logs': pa.schema([
+		('block_number', pa.int64()),
+		('block_hash', pa.binary()),
+		('transaction_hash', pa.binary()),
+		('transaction_index', pa.int32()),
+		('log_index', pa.int32()),
+		('address', pa.binary()),
+		('topics', pa.list_(pa.binary())),
+		('data', pa.binary()),
+	]),
+	'headers': pa.schema([
+		('block_number', pa.int64()),
+		('block_hash', pa.binary()),
+		('timestamp', pa.int64()),
+	]),
+	'transactions': pa.schema([
+		('block_number', pa.int64()),
+		('hash', pa.binary()),
+		('transaction_index', pa.int32()),
+		('from', pa.binary()),
+		('to', pa.binary()),
+		('input', pa.binary()),
+	]),
+}
+
+
+def to_bytes(value):
+	return bytes(HexBytes(value)) if value is not None else None
+
+
+#append-only parquet segments of the raw logs, block headers and transaction inputs fetched from the node
+#partitioned by block range; every flush writes new part files so processes archive side by side
+#rows are flushed every flush_rows rows or flush_interval seconds, and checkpoints registered while rows are
+#buffered are written only after those rows, so a crash never leaves a checkpoint ahead of the archive
+class SegmentArchive:
+	def __init__(self, path, chain_name, segment_blocks=10000, flush_rows=50000, flush_interval=60, compression='zstd'):
+		self.logger = logging.getLogger("SegmentArchive")
+		self.root = os.path.join(path, chain_name)
+		self.segment_blocks = segment_blocks
+		self.flush_rows = flush_rows
+		self.flush_interval = flush_interval
+		self.compression = compression
+		self.buffers = {kind: [] for kind in SCHEMAS}
+		self.rows = 0
+		self.checkpoints = []
+		self.last_flush = time.time()
+		self.lock = threading.Lock()
+		#one flush at a time, so checkpoints are written in order
+		self.flush_lock = threading.Lock()
+		self.flushing = False
+		self.flusher = None
+		self.tables = LRUCache(8)
+		self.blocks = LRUCache(2)
+
+	def segment(self, number):
+		start = number // self.segment_blocks * self.segment_blocks
+		return f'{start:012d}-{start + self.segment_blocks - 1:012d}'
+
+	def add(self, kind, rows):
+		with self.lock:
+			self.buffers[kind].extend(rows)
+			self.rows += len(rows)
+			#started on first use so it runs in the process that archives
+			if self.flusher is None:
+				self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+				self.flusher.start()
+		self.flush_due()
+
+	#write is called at once when nothing is buffered or being written, otherwise right after the next flush
+	def checkpoint(self, write):
+		with self.lock:
+			if self.rows > 0 or self.flushing:
+				self.checkpoints.append(write)
+				return
+		write()
+
+	#logs as returned by web3 get_logs
+	def add_logs(self, logs):
+		self.add('logs', [{
+			'block_number': log['blockNumber'],
+			'block_hash': bytes(log['blockHash']),
+			'transaction_hash': bytes(log['transactionHash']),
+			'transaction_index': log['transactionIndex'],
+			'log_index': log['logIndex'],
+			'address': to_bytes(log['address']),
+			'topics': [bytes(x) for x in log['topics']],
+			'data': to_bytes(log['data']),
+		} for log in logs])
+
+	#raw eth_getBlockByNumber result; transactions are kept when the block was fetched in full
+	def add_block(self, number, block):
+		self.add('headers', [{'block_number': number, 'block_hash': to_bytes(block['hash']), 'timestamp': int(block['timestamp'], 16)}])
+		self.add('transactions', [{
+			'block_number': number,
+			'hash': to_bytes(tx['hash']),
+			'transaction_index': int(tx['transactionIndex'], 16),
+			'from': to_bytes(tx.get('from')),
+			'to': to_bytes(tx.get('to')),
+			'input': to_bytes(tx['input']),
+		} for tx in block.get('transactions', []) if isinstance(tx, dict)])
+
+	def flush_due(self):
+		if self.rows >= self.flush_rows or time.time() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	#flushes a quiet archive too
+	def flush_loop(self):
+		while True:
+			time.sleep(min(self.flush_interval, 5))
+			try:
+				self.flush_due()
+			except Exception as e:
+				self.logger.critical('Archive flush failed', exc_info=True)
+
+	#rows and checkpoints of a failed flush are kept for the next one; rows it already wrote are then written
+	#twice, which the readers drop as duplicates
+	def flush(self):
+		with self.flush_lock:
+			self.flush_buffers()
+
+	def flush_buffers(self):
+		with self.lock:
+			buffers = self.buffers
+			checkpoints = self.checkpoints
+			self.buffers = {kind: [] for kind in SCHEMAS}
+			self.checkpoints = []
+			self.rows = 0
+			self.last_flush = time.time()
+			self.flushing = True
+		try:
+			for kind, rows in buffers.items():
+				segments = {}
+				for row in rows:
+					segments.setdefault(self.segment(row['block_number']), []).append(row)
+				for segment, rows in segments.items():
+					self.write(kind, segment, rows)
+		except Exception as e:
+			with self.lock:
+				for kind, rows in buffers.items():
+					self.buffers[kind][:0] = rows
+					self.rows += len(rows)
+				self.checkpoints[:0] = checkpoints
+				self.flushing = False
+			raise
+		try:
+			for write in checkpoints:
+				write()
+		finally:
+			with self.lock:
+				self.flushing = False
+
+	#part files are written under a temporary name and renamed, readers never see a partial file
+	def write(self, kind, segment, rows):
+		directory = os.path.join(self.root, kind, segment)
+		os.makedirs(directory, exist_ok=True)
+		name = os.path.join(directory, f'part-{time.time_ns()}-{os.getpid()}.parquet')
+		pq.write_table(pa.Table.from_pylist(rows, schema=SCHEMAS[kind]), name + '.tmp', compression=self.compression)
+		os.rename(name + '.tmp', name)
+
+	#archived segments overlapping a block range, in block order
+	def segments(self, kind, from_block, to_block):
+		found = []
+		for directory in sorted(glob.glob(os.path.join(self.root, kind, '*-*'))):
+			start, end = [int(x) for x in os.path.basename(directory).split('-')]
+			if end >= from_block and start <= to_block:
+				found.append(os.path.basename(directory))
+		return found
+
+	def read(self, kind, segment):
+		table = self.tables.get((kind, segment))
+		if table is None:
+			parts = sorted(glob.glob(os.path.join(self.root, kind, segment, '*.parquet')))
+			table = pa.concat_tables([pq.read_table(x) for x in parts]).to_pylist() if len(parts) > 0 else []
+			self.tables.put((kind, segment), table)
+		return table
+
+	#logs of one segment within the range as web3 log entries, duplicates from overlapping fetches removed
+	def logs(self, segment, from_block, to_block):
+		logs = {}
+		for row in self.read('logs', segment):
+			if from_block <= row['block_number'] <= to_block:
+				logs[(row['block_hash'], row['log_index'])] = row
+		for row in sorted(logs.values(), key=lambda x: (x['block_number'], x['log_index'])):
+			yield AttributeDict({
+				'address': Web3.toChecksumAddress(row['address']),
+				'blockHash': HexBytes(row['block_hash']),
+				'blockNumber': row['block_number'],
+				'data': Web3.toHex(row['data']),
+				'logIndex': row['log_index'],
+				'removed': False,
+				'topics': [HexBytes(x) for x in row['topics']],
+				'transactionHash': HexBytes(row['transaction_hash']),
+				'transactionIndex': row['transaction_index'],
+			})
+
+	def timestamps(self, segment, from_block, to_block):
+		return {row['block_number']: row['timestamp'] for row in self.read('headers', segment) if from_block <= row['block_number'] <= to_block}
+
+	#archived full block in eth_getBlockByNumber form, None if its transactions were never archived
+	def block(self, number):
+		segment = self.segment(number)
+		blocks = self.blocks.get(segment)
+		if blocks is None:
+			blocks = {}
+			for row in self.read('headers', segment):
+				blocks.setdefault(row['block_number'], {'timestamp': hex(row['timestamp']), 'transactions': {}})
+			for row in self.read('transactions', segment):
+				block = blocks.setdefault(row['block_number'], {'transactions': {}})
+				block['transactions'][row['hash']] = {
+					'hash': Web3.toHex(row['hash']),
+					'input': Web3.toHex(row['input']),
+				}
+			self.blocks.put(segment, blocks)
+		block = blocks.get(number)
+		if block is None or len(block['transactions']) == 0:
+			return None
+		return {**block, 'transactions': list(block['transactions'].values())}
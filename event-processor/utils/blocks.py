@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from utils.cache import LRUCache
+
+
+#the node returned no block yet, usually right at the head or on a lagging node
+class BlockUnavailable(Exception):
+	pass
+
+
+#block timestamps: bounded in-process window in front of expiring redis buckets shared by every worker
+class BlockStore:
+	def __init__(self, rpc, redis_cache, chain_name, size=10000, ttl=86400, bucket=1000, archive=None):
+		self.logger = logging.getLogger("BlockStore")
+		self.archive = archive
+		self.rpc = rpc
+		self.redis_cache = redis_cache
+		self.chain_name = chain_name
+		self.window = LRUCache(size, 'blocks')
+		self.ttl = ttl
+		self.bucket = bucket
+
+	#blocks are grouped into small redis hashes of `bucket` blocks that expire together
+	def key(self, number):
+		return f'Blocks-{self.chain_name}-{number // self.bucket}'
+
+	def load(self, numbers):
+		pipe = self.redis_cache.pipeline()
+		for number in numbers:
+			pipe.hget(self.key(number), number)
+		found = {}
+		for number, timestamp in zip(numbers, pipe.execute()):
+			if timestamp is not None:
+				found[number] = int(timestamp)
+				self.window.put(number, found[number])
+		return found
+
+	def store(self, timestamps):
+		pipe = self.redis_cache.pipeline()
+		for number, timestamp in timestamps.items():
+			pipe.hset(self.key(number), number, timestamp)
+			pipe.expire(self.key(number), self.ttl)
+			self.window.put(number, timestamp)
+		pipe.execute()
+
+	def parse(self, numbers, blocks):
+		timestamps = {}
+		for number, block in zip(numbers, blocks):
+			if isinstance(block, dict) and 'timestamp' in block:
+				timestamps[number] = int(block['timestamp'], 16)
+				if self.archive:
+					self.archive.add_block(number, block)
+		self.store(timestamps)
+		return timestamps
+
+	#load the headers of the given blocks, all missing ones in a single rpc batch
+	def prefetch(self, numbers):
+		missing = [x for x in sorted(set(numbers)) if self.window.get(x) is None]
+		if len(missing) == 0:
+			return
+		stored = self.load(missing)
+		missing = [x for x in missing if x not in stored]
+		if len(missing) > 0:
+			futures = [self.rpc.submit('eth_getBlockByNumber', [hex(x), False]) for x in missing]
+			blocks = []
+			for future in futures:
+				try:
+					blocks.append(future.result())
+				except Exception as e:
+					blocks.append(None)
+			self.parse(missing, blocks)
+
+	def get_timestamp(self, number):
+		timestamp = self.window.get(number)
+		if timestamp is None:
+			timestamp = self.load([number]).get(number)
+		if timestamp is None:
+			timestamp = self.parse([number], [self.rpc.call('eth_getBlockByNumber', [hex(number), False])]).get(number)
+		if timestamp is None:
+			raise BlockUnavailable(f'block {number} not served by the node')
+		return timestamp
+
+	#redis reads and writes run in the default executor so they never block the event loop
+	async def async_get_timestamp(self, arpc, number):
+		loop = asyncio.get_running_loop()
+		timestamp = self.window.get(number)
+		if timestamp is None:
+			timestamp = (await loop.run_in_executor(None, self.load, [number])).get(number)
+		if timestamp is None:
+			block = await arpc.call('eth_getBlockByNumber', [hex(number), False])
+			timestamp = (await loop.run_in_executor(None, self.parse, [number], [block])).get(number)
+		if timestamp is None:
+			raise BlockUnavailable(f'block {number} not served by the node')
+		return timestamp
@@ -0,0 +1,34 @@
+import threading
+from collections import OrderedDict
+from utils.metrics import CACHE_REQUESTS
+
+
+#bounded thread-safe lru with hit/miss counters; named caches also report them as metrics
+class LRUCache:
+	def __init__(self, size, name=None):
+		self.size = size
+		self.name = name
+		self.data = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		with self.lock:
+			if key in self.data:
+				self.data.move_to_end(key)
+				self.hits += 1
+				if self.name:
+					CACHE_REQUESTS.labels(self.name, 'hit').inc()
+				return self.data[key]
+			self.misses += 1
+			if self.name:
+				CACHE_REQUESTS.labels(self.name, 'miss').inc()
+			return None
+
+	def put(self, key, value):
+		with self.lock:
+			self.data[key] = value
+			self.data.move_to_end(key)
+			while len(self.data) > self.size:
+				self.data.popitem(last=False)
@@ -0,0 +1,94 @@
+import re
+from functools import lru_cache
+from hexbytes import HexBytes
+from web3 import Web3
+
+STATIC_TYPE = re.compile(r'^(uint|int)(\d*)$|^(address|bool)$')
+
+
+@lru_cache(maxsize=65536)
+def checksum_address(word):
+	return Web3.toChecksumAddress('0x' + word[12:].hex())
+
+
+def to_bytes(value):
+	if isinstance(value, str):
+		return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+	return bytes(value)
+
+
+def to_hex(value):
+	if isinstance(value, str):
+		return value
+	return HexBytes(value).hex()
+
+
+#word decoder for one static abi type; raises ValueError where eth_abi would reject the padding
+def word_decoder(_type):
+	match = STATIC_TYPE.match(_type)
+	if match.group(1):
+		bits = int(match.group(2) or 256)
+		if match.group(1) == 'uint':
+			def decode(word):
+				value = int.from_bytes(word, 'big')
+				if value >> bits:
+					raise ValueError(f'{_type} out of range')
+				return value
+		else:
+			def decode(word):
+				value = int.from_bytes(word, 'big', signed=True)
+				if not -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+					raise ValueError(f'{_type} out of range')
+				return value
+	elif match.group(3) == 'address':
+		def decode(word):
+			if any(word[:12]):
+				raise ValueError('address padding')
+			return checksum_address(word)
+	else:
+		def decode(word):
+			value = int.from_bytes(word, 'big')
+			if value > 1:
+				raise ValueError('bool out of range')
+			return value == 1
+	return decode
+
+
+#decodes logs of events made only of static word types by slicing topics and data directly
+class FastEventDecoder:
+	def __init__(self, abi):
+		self.name = abi['name']
+		self.indexed = [(x['name'], word_decoder(x['type'])) for x in abi['inputs'] if x.get('indexed')]
+		self.data = [(x['name'], word_decoder(x['type'])) for x in abi['inputs'] if not x.get('indexed')]
+		self.data_size = 32 * len(self.data)
+
+	@staticmethod
+	def supports(abi):
+		return not abi.get('anonymous') and all(STATIC_TYPE.match(x['type']) for x in abi['inputs'])
+
+	#same dict as processLog followed by Web3.toJSON/json.loads
+	def decode(self, log):
+		topics = log['topics']
+		if len(topics) != len(self.indexed) + 1:
+			raise ValueError(f'Expected {len(self.indexed)} log topics. Got {len(topics) - 1}')
+		data = to_bytes(log['data'])
+		if len(data) < self.data_size:
+			raise ValueError('log data too short')
+		args = {}
+		for (name, decode), topic in zip(self.indexed, topics[1:]):
+			args[name] = decode(to_bytes(topic))
+		for i, (name, decode) in enumerate(self.data):
+			args[name] = decode(data[32*i:32*(i+1)])
+		return {
+			'args': args,
+			'event': self.name,
+			'logIndex': log['logIndex'],
+			'transactionIndex': log['transactionIndex'],
+			'transactionHash': to_hex(log['transactionHash']),
+			'address': log['address'],
+			'blockHash': to_hex(log['blockHash']),
+			'blockNumber': log['blockNumber'],
+		}
+
+	def decode_batch(self, logs):
+		return [self.decode(log) for log in logs]
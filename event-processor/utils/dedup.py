@@ -0,0 +1,132 @@
+import hashlib
+import logging
+from redis.exceptions import ResponseError
+
+#KEYS: range set, seen-ranges bitmap, bloom meta hash, bloom layers 0..n
+#ARGV: member, range index, range ttl, hash1 high/low and hash2 high/low 32-bit words, bloom capacity,
+#bloom error rate, bits per bloom layer at most
+#returns 1 for a new log, 0 for a duplicate and -1 when fewer bloom layer keys than layers + 1 were passed
+#bit positions are (hash1 + i * hash2) mod m on the 64-bit hashes; lua numbers are doubles, so every product
+#is split to stay below 2^53
+CHECK_AND_SET = """
+local member = ARGV[1]
+local range = tonumber(ARGV[2])
+local layers = tonumber(redis.call('HGET', KEYS[3], 'layers') or '0')
+if #KEYS - 3 < layers + 1 then
+	return -1
+end
+local function mulmod(a, b, m)
+	return ((a * math.floor(b / 65536)) % m * 65536 + a * (b % 65536)) % m
+end
+local function hashmod(high, low, m)
+	return (mulmod(high % m, 4294967296 % m, m) + low % m) % m
+end
+local function positions(m, k)
+	local base = hashmod(tonumber(ARGV[4]), tonumber(ARGV[5]), m)
+	local step = hashmod(tonumber(ARGV[6]), tonumber(ARGV[7]), m)
+	local result = {}
+	for i = 0, k - 1 do
+		result[i + 1] = (base + i * step) % m
+	end
+	return result
+end
+if redis.call('SISMEMBER', KEYS[1], member) == 1 then
+	return 0
+end
+local exists = redis.call('EXISTS', KEYS[1])
+local seen = redis.call('GETBIT', KEYS[2], range)
+if exists == 0 and seen == 1 then
+	redis.call('SADD', KEYS[1], '~partial')
+end
+if (exists == 0 and seen == 1) or redis.call('SISMEMBER', KEYS[1], '~partial') == 1 then
+	for l = 0, layers - 1 do
+		local m = tonumber(redis.call('HGET', KEYS[3], 'm' .. l))
+		local k = tonumber(redis.call('HGET', KEYS[3], 'k' .. l))
+		local found = true
+		for _, position in ipairs(positions(m, k)) do
+			if redis.call('GETBIT', KEYS[4 + l], position) == 0 then
+				found = false
+				break
+			end
+		end
+		if found then
+			return 0
+		end
+	end
+end
+redis.call('SADD', KEYS[1], member)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SETBIT', KEYS[2], range, 1)
+local l = layers - 1
+if layers == 0 or tonumber(redis.call('HGET', KEYS[3], 'n' .. l)) >= tonumber(redis.call('HGET', KEYS[3], 'c' .. l)) then
+	l = layers
+	local capacity = tonumber(ARGV[8]) * math.pow(2, l)
+	local rate = tonumber(ARGV[9]) * math.pow(0.5, l + 1)
+	local m = math.ceil(-capacity * math.log(rate) / (math.log(2) ^ 2))
+	--layers stop doubling at the bit limit and hold fewer logs at the same error rate instead
+	if m > tonumber(ARGV[10]) then
+		m = tonumber(ARGV[10])
+		capacity = math.floor(-m * (math.log(2) ^ 2) / math.log(rate))
+	end
+	local k = math.ceil(-math.log(rate) / math.log(2))
+	redis.call('HSET', KEYS[3], 'layers', l + 1, 'm' .. l, m, 'k' .. l, k, 'c' .. l, capacity, 'n' .. l, 0)
+end
+local m = tonumber(redis.call('HGET', KEYS[3], 'm' .. l))
+local k = tonumber(redis.call('HGET', KEYS[3], 'k' .. l))
+for _, position in ipairs(positions(m, k)) do
+	redis.call('SETBIT', KEYS[4 + l], position, 1)
+end
+redis.call('HINCRBY', KEYS[3], 'n' .. l, 1)
+return 1
+"""
+
+
+#atomic log dedup keyed on (chain, block hash, log index)
+#recent block ranges keep an exact set that expires range_ttl after its last write; every log also goes into a
+#scalable bloom filter, which answers for a range once its set has expired; a layer has at most layer_bits bits,
+#below the 2^32 bit offsets redis allows in one string
+class EventDedup:
+	def __init__(self, redis_cache, chain_name, range_size=1000, range_ttl=3600, capacity=1000000, error_rate=0.000001, layer_bits=2**30):
+		self.logger = logging.getLogger("EventDedup")
+		self.redis_cache = redis_cache
+		self.chain_name = chain_name
+		self.range_size = range_size
+		self.range_ttl = range_ttl
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.layer_bits = min(layer_bits, 2**32)
+		self.prefix = f'Dedup-{chain_name}'
+		self.script = redis_cache.register_script(CHECK_AND_SET)
+		#bloom layers known to this process; the script asks for more keys once another process added one
+		self.layers = 0
+
+	#True the first time a log is seen, False for duplicates
+	#a failing script lets the log through, the gateway and the database still drop it by xhash if it was seen
+	def check_and_set(self, block_number, block_hash, log_index):
+		member = f'{block_hash}:{log_index}'
+		digest = hashlib.blake2b(f'{self.chain_name}:{member}'.encode('UTF-8'), digest_size=16).digest()
+		words = [int.from_bytes(digest[i:i+4], 'big') for i in range(0, 16, 4)]
+		words[3] |= 1
+		range_index = block_number // self.range_size
+		while True:
+			try:
+				result = self.script(
+					keys=[f'{self.prefix}-range-{range_index}', f'{self.prefix}-ranges', f'{self.prefix}-bloom'] +
+						[f'{self.prefix}-bloom-{l}' for l in range(0, self.layers + 1)],
+					args=[member, range_index, self.range_ttl] + words + [self.capacity, self.error_rate, self.layer_bits])
+			except ResponseError as e:
+				self.logger.critical(f'Dedup failed for {member}, accepting it: {e}')
+				return True
+			if result != -1:
+				return result == 1
+			self.layers = int(self.redis_cache.hget(f'{self.prefix}-bloom', 'layers') or 0)
+
+	#bytes used by the bloom layers and the live range sets
+	def memory(self):
+		usage = {'bloom': 0, 'ranges': 0, 'range_sets': 0}
+		for key in self.redis_cache.scan_iter(f'{self.prefix}-bloom*'):
+			usage['bloom'] += self.redis_cache.memory_usage(key) or 0
+		for key in self.redis_cache.scan_iter(f'{self.prefix}-range-*'):
+			usage['ranges'] += self.redis_cache.memory_usage(key) or 0
+			usage['range_sets'] += 1
+		return usage
@@ -0,0 +1,45 @@
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+#metrics shared by every event-processor process through PROMETHEUS_MULTIPROC_DIR, served by the main process
+
+RPC_CALLS = Counter('xquery_rpc_calls_total', 'JSON-RPC calls sent to the node', ['method', 'status'])
+RPC_LATENCY = Histogram('xquery_rpc_latency_seconds', 'JSON-RPC round trip by method', ['method'])
+CACHE_REQUESTS = Counter('xquery_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+STAGE_LATENCY = Histogram('xquery_stage_seconds', 'Time spent in each worker stage', ['stage'])
+EVENTS = Counter('xquery_events_total', 'Logs handled by the workers by outcome', ['result'])
+CURSOR = Gauge('xquery_block_cursor', 'Next block of each listener', ['cursor'], multiprocess_mode='max')
+HEAD = Gauge('xquery_chain_head', 'Latest block seen by the listeners', multiprocess_mode='max')
+BEHIND = Gauge('xquery_blocks_behind', 'Blocks between a listener cursor and its target block', ['cursor'], multiprocess_mode='livemax')
+WORKERS = Gauge('xquery_workers', 'Processor workers running per channel', ['queue'], multiprocess_mode='livemax')
+
+
+def observe_batch(batch, seconds):
+	for call_id, method, params, future in batch:
+		failed = not future.done() or future.cancelled() or future.exception() is not None
+		RPC_CALLS.labels(method, 'error' if failed else 'ok').inc()
+		RPC_LATENCY.labels(method).observe(seconds)
+
+def observe_cursor(cursor, block, target):
+	CURSOR.labels(cursor).set(block)
+	BEHIND.labels(cursor).set(max(0, target - block))
+
+
+#channel depths come from the shared counters of the main process
+class QueueCollector:
+	def __init__(self, channels):
+		self.channels = channels
+
+	def collect(self):
+		metric = GaugeMetricFamily('xquery_queue_depth', 'Items sent to a channel and not yet received', labels=['queue'])
+		for channel in self.channels:
+			metric.add_metric([channel.name], channel.qsize())
+		yield metric
+
+
+def start_metrics(port, channels):
+	registry = CollectorRegistry()
+	multiprocess.MultiProcessCollector(registry)
+	registry.register(QueueCollector(channels))
+	start_http_server(port, registry=registry)
@@ -0,0 +1,214 @@
+import time
+import asyncio
+import logging
+import threading
+from urllib.parse import urldefrag
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from web3.providers.base import JSONBaseProvider
+from utils.metrics import RPC_CALLS, RPC_LATENCY
+
+
+#requests per second allowed to one endpoint; rate 0 is unlimited
+class TokenBucket:
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = burst or max(1, rate)
+		self.tokens = self.burst
+		self.updated = time.time()
+
+	def refill(self):
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def take(self):
+		if self.rate <= 0:
+			return True
+		self.refill()
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return True
+		return False
+
+	#seconds until the next token
+	def wait_time(self):
+		if self.rate <= 0:
+			return 0
+		self.refill()
+		return max(0, (1 - self.tokens) / self.rate)
+
+
+#one rpc endpoint with latency and error rate averages; errors are forgiven over time so a failed node gets retried
+class Endpoint:
+	def __init__(self, url, rate, burst=None, alpha=0.2, recovery=30):
+		self.url = url
+		self.bucket = TokenBucket(rate, burst)
+		self.alpha = alpha
+		self.recovery = recovery
+		self.latency = 0
+		self.errors = 0
+		self.last_error = 0
+		self.requests = 0
+		self.failures = 0
+
+	def error_rate(self):
+		return self.errors * 0.5 ** ((time.time() - self.last_error) / self.recovery)
+
+	#lower is healthier
+	def score(self):
+		return (self.latency + 0.01) * (1 + 20 * self.error_rate())
+
+	def record(self, latency, ok):
+		self.requests += 1
+		self.latency = latency if self.requests == 1 else (1 - self.alpha) * self.latency + self.alpha * latency
+		self.errors = (1 - self.alpha) * self.error_rate() + (0 if ok else self.alpha)
+		if not ok:
+			self.failures += 1
+			self.last_error = time.time()
+
+
+#routes json-rpc posts to the healthiest endpoint within its rate limit and hedges slow ones to the next best
+#hosts may carry their own rate as a url fragment, e.g. https://node/rpc#25
+class RPCPool:
+	def __init__(self, hosts, rate=0, burst=None, hedge_after=1.0, hedge_factor=3.0, workers=32):
+		self.logger = logging.getLogger("RPCPool")
+		self.endpoints = []
+		for host in hosts:
+			url, fragment = urldefrag(host.strip())
+			self.endpoints.append(Endpoint(url, float(fragment) if fragment else rate, burst))
+		self.hedge_after = hedge_after
+		self.hedge_factor = hedge_factor
+		self.hedges = 0
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+
+	def stats(self):
+		return {e.url.split('//')[-1].split('/')[0]: f'{e.latency*1000:.0f}ms/{e.error_rate():.2f}/{e.requests}' for e in self.endpoints} | {'hedges': self.hedges}
+
+	#healthiest endpoint with a token to spend, or the seconds to wait for one
+	def pick(self, exclude=()):
+		with self.lock:
+			candidates = sorted([x for x in self.endpoints if x not in exclude], key=lambda x: x.score())
+			for endpoint in candidates:
+				if endpoint.bucket.take():
+					return endpoint, 0
+			return None, min([x.bucket.wait_time() for x in candidates], default=None)
+
+	def acquire(self, exclude=()):
+		while True:
+			endpoint, delay = self.pick(exclude)
+			if endpoint is not None or delay is None:
+				return endpoint
+			time.sleep(delay)
+
+	async def async_acquire(self, exclude=()):
+		while True:
+			endpoint, delay = self.pick(exclude)
+			if endpoint is not None or delay is None:
+				return endpoint
+			await asyncio.sleep(delay)
+
+	#wait for a response this long before asking another node; a hedged node is charged at least this latency
+	def hedge_delay(self, endpoint):
+		if len(self.endpoints) < 2:
+			return None
+		return min(self.hedge_after, max(0.05, self.hedge_factor * endpoint.latency))
+
+	def attempt(self, session, endpoint, body, timeout):
+		start = time.time()
+		try:
+			resp = session.post(endpoint.url, data=body, headers={'Content-Type': 'application/json'}, timeout=timeout)
+			resp.raise_for_status()
+			data = resp.json()
+		except Exception as e:
+			endpoint.record(time.time() - start, False)
+			raise
+		endpoint.record(time.time() - start, True)
+		return data
+
+	async def async_attempt(self, session, endpoint, body):
+		start = time.time()
+		try:
+			async with session.post(endpoint.url, data=body, headers={'Content-Type': 'application/json'}) as resp:
+				resp.raise_for_status()
+				data = await resp.json(content_type=None)
+		except Exception as e:
+			endpoint.record(time.time() - start, False)
+			raise
+		endpoint.record(time.time() - start, True)
+		return data
+
+	#post a json-rpc body; a slow node is hedged once and failures move on to the next untried endpoint
+	def request(self, session, body, timeout):
+		endpoint = self.acquire()
+		used = [endpoint]
+		delay = self.hedge_delay(endpoint)
+		attempts = {self.executor.submit(self.attempt, session, endpoint, body, timeout)}
+		error = None
+		done, _ = wait(attempts, timeout=delay)
+		hedged = False
+		while len(attempts) > 0:
+			if (len(done) == 0 and not hedged) or any(x.exception() is not None for x in done):
+				second = self.acquire(used)
+				if second is not None:
+					if len(done) == 0:
+						hedged = True
+						self.hedges += 1
+						endpoint.latency = max(endpoint.latency, delay)
+					used.append(second)
+					attempts.add(self.executor.submit(self.attempt, session, second, body, timeout))
+			done, attempts = wait(attempts, return_when=FIRST_COMPLETED)
+			for future in done:
+				if future.exception() is None:
+					return future.result()
+				error = future.exception()
+		raise error
+
+	async def async_request(self, session, body):
+		endpoint = await self.async_acquire()
+		used = [endpoint]
+		delay = self.hedge_delay(endpoint)
+		attempts = {asyncio.ensure_future(self.async_attempt(session, endpoint, body))}
+		error = None
+		done, _ = await asyncio.wait(attempts, timeout=delay)
+		hedged = False
+		try:
+			while len(attempts) > 0:
+				if (len(done) == 0 and not hedged) or any(x.exception() is not None for x in done):
+					second = await self.async_acquire(used)
+					if second is not None:
+						if len(done) == 0:
+							hedged = True
+							self.hedges += 1
+							endpoint.latency = max(endpoint.latency, delay)
+						used.append(second)
+						attempts.add(asyncio.ensure_future(self.async_attempt(session, second, body)))
+				done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+				for future in done:
+					if future.exception() is None:
+						return future.result()
+					error = future.exception()
+			raise error
+		finally:
+			for future in attempts:
+				future.cancel()
+
+
+#web3 provider sending every request through the pool
+class PoolProvider(JSONBaseProvider):
+	def __init__(self, pool, session, timeout=60):
+		super().__init__()
+		self.pool = pool
+		self.session = session
+		self.timeout = timeout
+
+	def make_request(self, method, params):
+		start = time.time()
+		try:
+			response = self.pool.request(self.session, self.encode_rpc_request(method, params), self.timeout)
+		except Exception as e:
+			RPC_CALLS.labels(method, 'error').inc()
+			raise
+		RPC_CALLS.labels(method, 'error' if 'error' in response else 'ok').inc()
+		RPC_LATENCY.labels(method).observe(time.time() - start)
+		return response
@@ -0,0 +1,89 @@
+import json
+from hexbytes import HexBytes
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector
+from web3 import Web3
+from web3._utils.abi import get_abi_input_names, get_abi_input_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from utils.decoder import FastEventDecoder, to_hex
+
+
+#topic0 and 4-byte selector lookups built once per process from the loaded abis
+class DecoderRegistry:
+	def __init__(self, web3, index_topics, event_abis, function_abis, fast=True):
+		self.web3 = web3
+		self.codec = web3.codec
+		self.fast = fast
+		self.events = {}
+		self.functions = {}
+		names = {}
+		for _type in list(index_topics):
+			for index_topic in index_topics[_type]:
+				names.setdefault(index_topic['topic'], (_type, index_topic['name']))
+		for abi in event_abis:
+			self.add_events(abi, names)
+		for abi in function_abis:
+			self.add_functions(abi)
+
+	#events of one abi; the first abi registering a topic wins
+	def add_events(self, abi, names):
+		contract = self.web3.eth.contract(abi=abi)
+		for entry in abi:
+			if entry.get('type') != 'event' or entry.get('anonymous'):
+				continue
+			topic = Web3.toHex(event_abi_to_log_topic(entry))
+			if topic in self.events:
+				continue
+			_type, name = names.get(topic, ('event', entry['name']))
+			self.events[topic] = {
+				'type': _type,
+				'name': name,
+				'decoder': getattr(contract.events, entry['name'])(),
+				'fast': FastEventDecoder(entry) if self.fast and FastEventDecoder.supports(entry) else None,
+			}
+
+	#functions of one abi; the first abi registering a selector wins
+	def add_functions(self, abi):
+		for entry in abi:
+			if entry.get('type') != 'function':
+				continue
+			selector = Web3.toHex(function_abi_to_4byte_selector(entry))
+			if selector in self.functions:
+				continue
+			self.functions[selector] = {
+				'name': entry['name'],
+				'names': get_abi_input_names(entry),
+				'types': get_abi_input_types(entry),
+			}
+
+	def get_event(self, topic):
+		return self.events.get(topic)
+
+	#decoded log as the plain dict produced by processLog and Web3.toJSON; static layouts skip web3
+	def decode_event(self, topic, log):
+		event = self.events[topic]
+		if event['fast']:
+			try:
+				return event['fast'].decode(log)
+			except ValueError as e:
+				pass
+		return json.loads(Web3.toJSON(event['decoder'].processLog(log)))
+
+	#decode a batch of logs, None for logs without a registered topic or failing to decode
+	def decode_events(self, logs):
+		decoded = []
+		for log in logs:
+			try:
+				decoded.append(self.decode_event(to_hex(log['topics'][0]), log))
+			except Exception as e:
+				decoded.append(None)
+		return decoded
+
+	#decoded transaction input as (fn_name, args) or None if the selector is unknown
+	def decode_function(self, data):
+		data = HexBytes(data)
+		function = self.functions.get(Web3.toHex(data[:4]))
+		if function is None:
+			return None
+		decoded = self.codec.decode_abi(function['types'], data[4:])
+		normalized = map_abi_data(BASE_RETURN_NORMALIZERS, function['types'], decoded)
+		return function['name'], dict(zip(function['names'], normalized))
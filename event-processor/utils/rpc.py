@@ -0,0 +1,175 @@
+import json
+import time
+import asyncio
+import aiohttp
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils.metrics import observe_batch
+
+
+class RPCError(Exception):
+	pass
+
+
+#collects json-rpc calls from many threads and sends them to the endpoint pool as batch arrays
+class BatchRPC:
+	def __init__(self, pool, session, batch_size=50, deadline=0.01, workers=4, timeout=60):
+		self.logger = logging.getLogger("BatchRPC")
+		self.pool = pool
+		self.session = session
+		self.batch_size = batch_size
+		self.deadline = deadline
+		self.timeout = timeout
+		self.pending = []
+		self.oldest = None
+		self.next_id = 0
+		self.condition = threading.Condition()
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.thread = threading.Thread(target=self.flush_loop, daemon=True)
+		self.thread.start()
+
+	#queue a call for the next batch; returns a future with the call result
+	def submit(self, method, params):
+		future = Future()
+		with self.condition:
+			if len(self.pending) == 0:
+				self.oldest = time.time()
+			self.next_id += 1
+			self.pending.append((self.next_id, method, params, future))
+			if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+				self.condition.notify()
+		return future
+
+	def call(self, method, params):
+		return self.submit(method, params).result()
+
+	#submit all calls before waiting so they share batches
+	def call_many(self, calls):
+		futures = [self.submit(method, params) for method, params in calls]
+		return [future.result() for future in futures]
+
+	def flush_loop(self):
+		while True:
+			with self.condition:
+				while len(self.pending) == 0:
+					self.condition.wait()
+				while len(self.pending) < self.batch_size:
+					remaining = self.oldest + self.deadline - time.time()
+					if remaining <= 0:
+						break
+					self.condition.wait(remaining)
+				batch = self.pending[:self.batch_size]
+				self.pending = self.pending[self.batch_size:]
+				self.oldest = time.time() if len(self.pending) > 0 else None
+			self.executor.submit(self.send, batch)
+
+	def send(self, batch):
+		futures = {}
+		payload = []
+		for call_id, method, params, future in batch:
+			futures[call_id] = future
+			payload.append({'jsonrpc': '2.0', 'id': call_id, 'method': method, 'params': params})
+		start = time.time()
+		try:
+			data = self.pool.request(self.session, json.dumps(payload), self.timeout)
+			if not isinstance(data, list):
+				raise RPCError(data)
+			for item in data:
+				future = futures.pop(item.get('id'), None)
+				if future is None:
+					continue
+				if item.get('error'):
+					future.set_exception(RPCError(item['error']))
+				else:
+					future.set_result(item.get('result'))
+			for future in futures.values():
+				future.set_exception(RPCError('missing response in batch'))
+		except Exception as e:
+			self.logger.critical(f'Batch of {len(batch)} calls failed: {e}')
+			for future in futures.values():
+				if not future.done():
+					future.set_exception(e)
+		observe_batch(batch, time.time() - start)
+
+
+#asyncio counterpart of BatchRPC over a pooled aiohttp session; use from a single event loop
+class AsyncBatchRPC:
+	def __init__(self, pool, batch_size=50, deadline=0.01, connections=100, timeout=60):
+		self.logger = logging.getLogger("AsyncBatchRPC")
+		self.pool = pool
+		self.batch_size = batch_size
+		self.deadline = deadline
+		self.connections = connections
+		self.timeout = timeout
+		self.session = None
+		self.pending = []
+		self.timer = None
+		self.sending = set()
+		self.next_id = 0
+
+	async def start(self):
+		self.session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(limit=self.connections),
+			timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+	async def close(self):
+		await self.session.close()
+
+	#queue a call for the next batch; returns an awaitable future with the call result
+	def submit(self, method, params):
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self.next_id += 1
+		self.pending.append((self.next_id, method, params, future))
+		if len(self.pending) >= self.batch_size:
+			self.flush()
+		elif self.timer is None:
+			self.timer = loop.call_later(self.deadline, self.flush)
+		return future
+
+	async def call(self, method, params):
+		return await self.submit(method, params)
+
+	async def call_many(self, calls):
+		return await asyncio.gather(*[self.submit(method, params) for method, params in calls])
+
+	def flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		while len(self.pending) > 0:
+			batch = self.pending[:self.batch_size]
+			self.pending = self.pending[self.batch_size:]
+			task = asyncio.ensure_future(self.send(batch))
+			self.sending.add(task)
+			task.add_done_callback(self.sending.discard)
+
+	async def send(self, batch):
+		futures = {}
+		payload = []
+		for call_id, method, params, future in batch:
+			futures[call_id] = future
+			payload.append({'jsonrpc': '2.0', 'id': call_id, 'method': method, 'params': params})
+		start = time.time()
+		try:
+			data = await self.pool.async_request(self.session, json.dumps(payload))
+			if not isinstance(data, list):
+				raise RPCError(data)
+			for item in data:
+				future = futures.pop(item.get('id'), None)
+				if future is None or future.done():
+					continue
+				if item.get('error'):
+					future.set_exception(RPCError(item['error']))
+				else:
+					future.set_result(item.get('result'))
+			for future in futures.values():
+				if not future.done():
+					future.set_exception(RPCError('missing response in batch'))
+		except Exception as e:
+			self.logger.critical(f'Batch of {len(batch)} calls failed: {e}')
+			for future in futures.values():
+				if not future.done():
+					future.set_exception(e)
+		observe_batch(batch, time.time() - start)
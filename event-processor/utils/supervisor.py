@@ -0,0 +1,156 @@
+import time
+import logging
+from multiprocessing import Process
+from utils.metrics import WORKERS
+
+
+def spawn(target, args):
+	process = Process(target=target, args=args)
+	process.daemon = True
+	process.start()
+	return process
+
+
+#one long lived process; 'always' restarts it whenever it exits, 'failure' only when it exits non-zero
+#so listeners that completed their range stay down; a role stopped last outlives every other process on shutdown
+class Role:
+	def __init__(self, name, target, args, restart='always', last=False):
+		self.logger = logging.getLogger("Supervisor")
+		self.name = name
+		self.target = target
+		self.args = args
+		self.restart = restart
+		self.last = last
+		self.process = None
+		self.done = False
+
+	def check(self):
+		if self.done or (self.process is not None and self.process.is_alive()):
+			return
+		if self.process is not None:
+			self.logger.info(f'{self.name} exited with code {self.process.exitcode}')
+			if self.restart == 'failure' and self.process.exitcode == 0:
+				self.done = True
+				return
+		self.process = spawn(self.target, self.args)
+		self.logger.info(f'{self.name} started pid {self.process.pid}')
+
+	def processes(self):
+		return [self.process] if self.process is not None else []
+
+
+#processor workers of one channel, resized between minimum and maximum; the backlog lag is the time the
+#channel backlog takes to drain at the rate consumers took items since the previous check
+class WorkerPool:
+	def __init__(self, channel, target, args, minimum=1, maximum=4, scale_up_lag=5, scale_up_backlog=1000, scale_down_lag=1, scale_down_checks=6, stop_timeout=60):
+		self.logger = logging.getLogger("Supervisor")
+		self.channel = channel
+		self.target = target
+		self.args = args
+		self.minimum = minimum
+		self.maximum = max(minimum, maximum)
+		self.scale_up_lag = scale_up_lag
+		self.scale_up_backlog = scale_up_backlog
+		self.scale_down_lag = scale_down_lag
+		self.scale_down_checks = scale_down_checks
+		self.stop_timeout = stop_timeout
+		self.size = minimum
+		self.workers = []
+		self.stopping = {}
+		self.idle = 0
+		self.received = channel.received.value
+		self.last_check = time.time()
+
+	def lag(self, now):
+		backlog = self.channel.qsize()
+		received = self.channel.received.value
+		rate = (received - self.received) / max(now - self.last_check, 1e-6)
+		self.received = received
+		self.last_check = now
+		if backlog <= 0:
+			return backlog, 0
+		return backlog, backlog / rate if rate > 0 else float('inf')
+
+	def resize(self, now):
+		backlog, lag = self.lag(now)
+		if lag > self.scale_up_lag and backlog >= self.scale_up_backlog and self.size < self.maximum:
+			self.size += 1
+			self.idle = 0
+			self.logger.info(f'{self.channel.name} backlog {backlog} lag {lag:.1f}s, scaling up to {self.size} workers')
+		elif lag < self.scale_down_lag:
+			self.idle += 1
+			if self.idle >= self.scale_down_checks and self.size > self.minimum:
+				self.size -= 1
+				self.idle = 0
+				self.logger.info(f'{self.channel.name} backlog {backlog} lag {lag:.1f}s, scaling down to {self.size} workers')
+		else:
+			self.idle = 0
+
+	#workers scaled down get SIGTERM and finish the events they already took; killed if they outlive stop_timeout
+	def check(self, now):
+		for process in [x for x in self.workers if not x.is_alive()]:
+			self.logger.info(f'{self.channel.name} worker {process.pid} exited with code {process.exitcode}')
+			self.workers.remove(process)
+		for process, stopped in list(self.stopping.items()):
+			if not process.is_alive():
+				del self.stopping[process]
+			elif now - stopped > self.stop_timeout:
+				self.logger.info(f'{self.channel.name} worker {process.pid} did not stop, killing')
+				process.kill()
+		self.resize(now)
+		while len(self.workers) > self.size:
+			process = self.workers.pop()
+			process.terminate()
+			self.stopping[process] = now
+		while len(self.workers) < self.size:
+			self.workers.append(spawn(self.target, self.args))
+		WORKERS.labels(self.channel.name).set(len(self.workers))
+
+	def processes(self):
+		return self.workers + list(self.stopping)
+
+
+#keeps the event-processor processes running; dead processes are replaced on the next check,
+#which also bounds restarts of a crashing process to one per interval
+class Supervisor:
+	def __init__(self, interval=5):
+		self.logger = logging.getLogger("Supervisor")
+		self.interval = interval
+		self.roles = []
+		self.pools = []
+
+	def add(self, name, target, args, restart='always', last=False):
+		self.roles.append(Role(name, target, args, restart, last))
+
+	def add_pool(self, channel, target, args, **kwargs):
+		self.pools.append(WorkerPool(channel, target, args, **kwargs))
+
+	def check(self):
+		now = time.time()
+		for role in self.roles:
+			role.check()
+		for pool in self.pools:
+			pool.check(now)
+
+	def run(self):
+		while True:
+			self.check()
+			time.sleep(self.interval)
+
+	#processes are stopped from upstream to downstream, so each one flushes into a channel that is still read:
+	#listeners, then processor pools, then the roles added last; every stage gets SIGTERM and timeout seconds
+	#before what is left of it is killed
+	def stop(self, timeout=10):
+		for stage in [[x for x in self.roles if not x.last], self.pools, [x for x in self.roles if x.last]]:
+			self.terminate([x for role in stage for x in role.processes() if x.is_alive()], timeout)
+
+	def terminate(self, processes, timeout):
+		for process in processes:
+			process.terminate()
+		deadline = time.time() + timeout
+		for process in processes:
+			process.join(max(0, deadline - time.time()))
+			if process.is_alive():
+				self.logger.info(f'{process.pid} did not stop, killing')
+				process.kill()
+				process.join()
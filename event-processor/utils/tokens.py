@@ -0,0 +1,238 @@
+import asyncio
+import logging
+from web3 import Web3
+from utils.cache import LRUCache
+from utils.metrics import CACHE_REQUESTS
+
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+
+#token and pair metadata: process lru in front of compact redis hashes, misses fetched in bulk through multicall
+class TokenCache:
+	def __init__(self, rpc, codec, redis_cache, size=10000, multicall=MULTICALL3_ADDRESS, chunk=150):
+		self.logger = logging.getLogger("TokenCache")
+		self.rpc = rpc
+		self.codec = codec
+		self.redis_cache = redis_cache
+		self.tokens = LRUCache(size, 'tokens')
+		self.pairs = LRUCache(size, 'pairs')
+		self.multicall = Web3.toChecksumAddress(multicall) if multicall else None
+		self.multicall_errors = 0
+		self.chunk = chunk
+		self.redis_hits = 0
+		self.redis_misses = 0
+		self.selectors = {fn: Web3.keccak(text=sig)[:4] for fn, sig in [
+			('name', 'name()'),
+			('symbol', 'symbol()'),
+			('decimals', 'decimals()'),
+			('token0', 'token0()'),
+			('token1', 'token1()'),
+			('tryAggregate', 'tryAggregate(bool,(address,bytes)[])'),
+		]}
+
+	def stats(self):
+		return {
+			'token_hits': self.tokens.hits,
+			'token_misses': self.tokens.misses,
+			'pair_hits': self.pairs.hits,
+			'pair_misses': self.pairs.misses,
+			'redis_hits': self.redis_hits,
+			'redis_misses': self.redis_misses,
+		}
+
+	def use_multicall(self):
+		return self.multicall is not None and self.multicall_errors < 3
+
+	def multicall_failed(self, e):
+		self.multicall_errors += 1
+		self.logger.warning(f'Multicall failed, using single eth_calls: {e}')
+
+	def multicall_requests(self, calls):
+		requests = []
+		for i in range(0, len(calls), self.chunk):
+			data = self.selectors['tryAggregate'] + self.codec.encode_abi(['bool', '(address,bytes)[]'], [False, calls[i:i+self.chunk]])
+			requests.append(('eth_call', [{'to': self.multicall, 'data': Web3.toHex(data)}, 'latest']))
+		return requests
+
+	def multicall_results(self, responses):
+		results = []
+		for response in responses:
+			if isinstance(response, Exception):
+				raise response
+			for success, data in self.codec.decode_abi(['(bool,bytes)[]'], Web3.toBytes(hexstr=response))[0]:
+				results.append(data if success else None)
+		self.multicall_errors = 0
+		return results
+
+	def single_requests(self, calls):
+		return [('eth_call', [{'to': target, 'data': Web3.toHex(data)}, 'latest']) for target, data in calls]
+
+	def single_results(self, responses):
+		return [None if isinstance(response, Exception) else Web3.toBytes(hexstr=response) for response in responses]
+
+	#send rpc requests through the batch client; failed calls come back as their exception
+	def call_all(self, requests):
+		futures = [self.rpc.submit(method, params) for method, params in requests]
+		responses = []
+		for future in futures:
+			try:
+				responses.append(future.result())
+			except Exception as e:
+				responses.append(e)
+		return responses
+
+	async def async_call_all(self, arpc, requests):
+		return await asyncio.gather(*[arpc.submit(method, params) for method, params in requests], return_exceptions=True)
+
+	#run view calls as (target, calldata); returns raw return data or None per call
+	def aggregate(self, calls):
+		if self.use_multicall():
+			try:
+				return self.multicall_results(self.call_all(self.multicall_requests(calls)))
+			except Exception as e:
+				self.multicall_failed(e)
+		return self.single_results(self.call_all(self.single_requests(calls)))
+
+	async def async_aggregate(self, arpc, calls):
+		if self.use_multicall():
+			try:
+				return self.multicall_results(await self.async_call_all(arpc, self.multicall_requests(calls)))
+			except Exception as e:
+				self.multicall_failed(e)
+		return self.single_results(await self.async_call_all(arpc, self.single_requests(calls)))
+
+	def decode(self, result, output_type):
+		try:
+			if output_type == 'string':
+				try:
+					return self.codec.decode_single('string', result)
+				except Exception as e:
+					return self.codec.decode_single('bytes32', result).rstrip(b'\x00').decode('UTF-8', 'ignore')
+			return self.codec.decode_single(output_type, result)
+		except Exception as e:
+			return None
+
+	#load hashes from redis in one pipeline; returns the found ones by address
+	def load(self, prefix, addresses):
+		pipe = self.redis_cache.pipeline()
+		for address in addresses:
+			pipe.hgetall(prefix + address)
+		found = {}
+		for address, value in zip(addresses, pipe.execute()):
+			if value:
+				found[address] = {k.decode('UTF-8'): v.decode('UTF-8') for k, v in value.items()}
+				self.redis_hits += 1
+				CACHE_REQUESTS.labels('token_redis', 'hit').inc()
+			else:
+				self.redis_misses += 1
+				CACHE_REQUESTS.labels('token_redis', 'miss').inc()
+		return found
+
+	def store(self, prefix, items):
+		pipe = self.redis_cache.pipeline()
+		for address, value in items.items():
+			pipe.hset(prefix + address, mapping=value)
+		pipe.execute()
+
+	#split addresses into cached entries (lru, then redis) and the ones still to fetch
+	def lookup(self, lru, prefix, addresses, parse):
+		found = {}
+		missing = []
+		for address in addresses:
+			if address in found or address in missing:
+				continue
+			data = lru.get(address)
+			if data is None:
+				missing.append(address)
+			else:
+				found[address] = data
+		if len(missing) > 0:
+			stored = self.load(prefix, missing)
+			for address, value in stored.items():
+				data = parse(value)
+				lru.put(address, data)
+				found[address] = data
+			missing = [x for x in missing if x not in stored]
+		return found, missing
+
+	def parse_token(self, value):
+		return {
+			'name': value['name'] or None,
+			'symbol': value['symbol'] or None,
+			'decimals': int(value['decimals']) if value['decimals'] else None
+		}
+
+	def parse_pair(self, value):
+		return value
+
+	def token_calls(self, addresses):
+		return [(Web3.toChecksumAddress(address), self.selectors[fn]) for address in addresses for fn in ['name', 'symbol', 'decimals']]
+
+	def add_tokens(self, tokens, addresses, results):
+		fetched = {}
+		for i, address in enumerate(addresses):
+			name, symbol, decimals = results[3*i:3*i+3]
+			name = self.decode(name, 'string') if name else None
+			symbol = self.decode(symbol, 'string') if symbol else None
+			decimals = self.decode(decimals, 'uint8') if decimals else None
+			fetched[address] = {
+				'name': str(name) if name else '',
+				'symbol': str(symbol) if symbol else '',
+				'decimals': str(int(decimals)) if decimals else ''
+			}
+			tokens[address] = self.parse_token(fetched[address])
+			self.tokens.put(address, tokens[address])
+		self.store('Token-', fetched)
+
+	def pair_calls(self, addresses):
+		return [(Web3.toChecksumAddress(address), self.selectors[fn]) for address in addresses for fn in ['token0', 'token1']]
+
+	def add_pairs(self, pairs, addresses, results):
+		fetched = {}
+		for i, address in enumerate(addresses):
+			token0 = self.decode(results[2*i], 'address') if results[2*i] else None
+			token1 = self.decode(results[2*i+1], 'address') if results[2*i+1] else None
+			if token0 and token1:
+				fetched[address] = {'token0': token0, 'token1': token1}
+				pairs[address] = fetched[address]
+				self.pairs.put(address, pairs[address])
+		self.store('Pair-', fetched)
+
+	def pair_token_addresses(self, addresses, pairs):
+		return [x for address in addresses if address in pairs for x in [pairs[address]['token0'], pairs[address]['token1']]]
+
+	def pair_tokens(self, addresses, pairs, tokens):
+		return [{'token0': tokens[pairs[address]['token0']], 'token1': tokens[pairs[address]['token1']]} if address in pairs else None for address in addresses]
+
+	#name, symbol and decimals for each token address
+	def get_tokens(self, addresses):
+		tokens, fetch = self.lookup(self.tokens, 'Token-', addresses, self.parse_token)
+		if len(fetch) > 0:
+			self.add_tokens(tokens, fetch, self.aggregate(self.token_calls(fetch)))
+		return [tokens[address] for address in addresses]
+
+	#the redis lookups and stores run in the default executor so they never block the event loop
+	async def async_get_tokens(self, arpc, addresses):
+		loop = asyncio.get_running_loop()
+		tokens, fetch = await loop.run_in_executor(None, self.lookup, self.tokens, 'Token-', addresses, self.parse_token)
+		if len(fetch) > 0:
+			results = await self.async_aggregate(arpc, self.token_calls(fetch))
+			await loop.run_in_executor(None, self.add_tokens, tokens, fetch, results)
+		return [tokens[address] for address in addresses]
+
+	#token0 and token1 details for each pair address, None where the contract is not a pair
+	def get_pairs(self, addresses):
+		pairs, fetch = self.lookup(self.pairs, 'Pair-', addresses, self.parse_pair)
+		if len(fetch) > 0:
+			self.add_pairs(pairs, fetch, self.aggregate(self.pair_calls(fetch)))
+		token_addresses = self.pair_token_addresses(addresses, pairs)
+		return self.pair_tokens(addresses, pairs, dict(zip(token_addresses, self.get_tokens(token_addresses))))
+
+	async def async_get_pairs(self, arpc, addresses):
+		loop = asyncio.get_running_loop()
+		pairs, fetch = await loop.run_in_executor(None, self.lookup, self.pairs, 'Pair-', addresses, self.parse_pair)
+		if len(fetch) > 0:
+			results = await self.async_aggregate(arpc, self.pair_calls(fetch))
+			await loop.run_in_executor(None, self.add_pairs, pairs, fetch, results)
+		token_addresses = self.pair_token_addresses(addresses, pairs)
+		return self.pair_tokens(addresses, pairs, dict(zip(token_addresses, await self.async_get_tokens(arpc, token_addresses))))
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from utils.cache import LRUCache
+
+
+#decoded transaction inputs by tx hash; a miss loads the whole block with full transactions once
+#and decodes every input against the selector index, so all events of a block share one fetch
+class TransactionStore:
+	def __init__(self, rpc, decode, blocks, size=50000, archive=None, replay=False):
+		self.logger = logging.getLogger("TransactionStore")
+		self.archive = archive
+		self.replay = replay
+		self.rpc = rpc
+		self.decode = decode
+		self.blocks = blocks
+		self.functions = LRUCache(size, 'transactions')
+		self.pending = {}
+		self.async_pending = {}
+		self.lock = threading.Lock()
+		self.block_fetches = 0
+		self.tx_fetches = 0
+
+	def stats(self):
+		return {
+			'hits': self.functions.hits,
+			'misses': self.functions.misses,
+			'block_fetches': self.block_fetches,
+			'tx_fetches': self.tx_fetches,
+		}
+
+	#full blocks carry the header too, so the timestamp is stored on the way
+	def parse(self, number, block):
+		if not isinstance(block, dict):
+			return
+		if 'timestamp' in block:
+			self.blocks.store({number: int(block['timestamp'], 16)})
+		for transaction in block.get('transactions', []):
+			self.functions.put(transaction['hash'], self.decode(transaction))
+
+	#replays read archived blocks first; blocks from the node are archived when an archive is set
+	def fetch_block(self, number):
+		block = self.archive.block(number) if self.archive and self.replay else None
+		if block is None:
+			self.block_fetches += 1
+			block = self.rpc.call('eth_getBlockByNumber', [hex(number), True])
+			if self.archive and not self.replay and isinstance(block, dict):
+				self.archive.add_block(number, block)
+		return block
+
+	async def async_fetch_block(self, arpc, number):
+		block = self.archive.block(number) if self.archive and self.replay else None
+		if block is None:
+			self.block_fetches += 1
+			block = await arpc.call('eth_getBlockByNumber', [hex(number), True])
+			if self.archive and not self.replay and isinstance(block, dict):
+				self.archive.add_block(number, block)
+		return block
+
+	#one caller per block fetches it, concurrent callers for the same block wait on its future
+	def load_block(self, number):
+		with self.lock:
+			future = self.pending.get(number)
+			owner = future is None
+			if owner:
+				future = Future()
+				self.pending[number] = future
+		if owner:
+			try:
+				self.parse(number, self.fetch_block(number))
+				future.set_result(True)
+			except Exception as e:
+				future.set_exception(e)
+			finally:
+				with self.lock:
+					del self.pending[number]
+		future.result()
+
+	#parse stores the timestamp in redis, so it runs off the event loop
+	async def async_fetch_and_parse(self, arpc, number):
+		block = await self.async_fetch_block(arpc, number)
+		await asyncio.get_running_loop().run_in_executor(None, self.parse, number, block)
+
+	#one task per block fetches and parses it, concurrent callers wait until its transactions are decoded
+	async def async_load_block(self, arpc, number):
+		task = self.async_pending.get(number)
+		if task is None:
+			task = asyncio.ensure_future(self.async_fetch_and_parse(arpc, number))
+			self.async_pending[number] = task
+			try:
+				await task
+			finally:
+				del self.async_pending[number]
+		else:
+			await task
+
+	#decoded input of a transaction in the given block; falls back to the single transaction if the block lacks it
+	def get_function(self, number, tx):
+		function = self.functions.get(tx)
+		if function is None:
+			self.load_block(number)
+			function = self.functions.get(tx)
+		if function is None:
+			self.tx_fetches += 1
+			function = self.decode(self.rpc.call('eth_getTransactionByHash', [tx]))
+			self.functions.put(tx, function)
+		return function
+
+	async def async_get_function(self, arpc, number, tx):
+		function = self.functions.get(tx)
+		if function is None:
+			await self.async_load_block(arpc, number)
+			function = self.functions.get(tx)
+		if function is None:
+			self.tx_fetches += 1
+			function = self.decode(await arpc.call('eth_getTransactionByHash', [tx]))
+			self.functions.put(tx, function)
+		return function
@@ -0,0 +1,198 @@
+import time
+import pickle
+import logging
+import threading
+from queue import Empty
+from collections import deque
+from multiprocessing import Value
+import zmq
+
+
+#bounded inter-process channel moving pickled batches over zmq ipc sockets
+#producers PUSH into a device owned by the main process; consumers ask it for one batch at a time,
+#so the backlog stays in the device and is shared by consumers started or stopped at any time
+class Channel:
+	def __init__(self, name, batch_size=100, flush_interval=0.05, capacity=10000, path='/tmp'):
+		self.name = name
+		self.frontend = f'ipc://{path}/xquery-{name}-in.ipc'
+		self.backend = f'ipc://{path}/xquery-{name}-out.ipc'
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.hwm = max(1, capacity // batch_size)
+		self.sent = Value('q', 0)
+		self.received = Value('q', 0)
+
+	#items sent by producers and not yet taken by a consumer
+	def qsize(self):
+		return self.sent.value - self.received.value
+
+	def start(self):
+		thread = threading.Thread(target=self.device, daemon=True)
+		thread.start()
+
+	#consumers send 'ready' for a batch and 'cancel' to withdraw it; a cancel is always answered with an empty frame
+	#a consumer that said ready and then exited is unreachable, its batch goes to the next ready consumer
+	def device(self):
+		logger = logging.getLogger('Channel')
+		context = zmq.Context.instance()
+		frontend = context.socket(zmq.PULL)
+		frontend.set_hwm(self.hwm)
+		frontend.bind(self.frontend)
+		backend = context.socket(zmq.ROUTER)
+		backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+		backend.bind(self.backend)
+		ready = deque()
+		pending = None
+		while True:
+			sockets = [backend, frontend] if len(ready) > 0 and pending is None else [backend]
+			#a batch held back by a full consumer pipe is retried after a short wait
+			readable, _, _ = zmq.select(sockets, [], [], 0.1 if pending is not None else None)
+			if backend in readable:
+				consumer, command = backend.recv_multipart()
+				if command == b'ready':
+					ready.append(consumer)
+				else:
+					if consumer in ready:
+						ready.remove(consumer)
+					try:
+						backend.send_multipart([consumer, b''], zmq.NOBLOCK)
+					except zmq.ZMQError as e:
+						pass
+			if frontend in readable and len(ready) > 0 and pending is None:
+				pending = frontend.recv()
+			while pending is not None and len(ready) > 0:
+				consumer = ready.popleft()
+				try:
+					backend.send_multipart([consumer, pending], zmq.NOBLOCK)
+					pending = None
+				except zmq.ZMQError as e:
+					if e.errno == zmq.EAGAIN:
+						ready.append(consumer)
+						break
+					logger.info(f'Consumer {consumer.hex()} of channel {self.name} is gone, requeueing its batch')
+
+	def sender(self):
+		return ChannelSender(self)
+
+	def receiver(self):
+		return ChannelReceiver(self)
+
+
+#producer end; buffers items and sends them as one frame per batch, blocking when the channel is full
+class ChannelSender:
+	def __init__(self, channel):
+		self.logger = logging.getLogger("ChannelSender")
+		self.channel = channel
+		self.buffer = []
+		self.socket = None
+		self.lock = threading.Lock()
+		self.last_flush = time.time()
+
+	def connect(self):
+		self.socket = zmq.Context.instance().socket(zmq.PUSH)
+		self.socket.set_hwm(self.channel.hwm)
+		self.socket.connect(self.channel.frontend)
+		thread = threading.Thread(target=self.flush_loop, daemon=True)
+		thread.start()
+
+	def put(self, item):
+		with self.lock:
+			if self.socket is None:
+				self.connect()
+			self.buffer.append(item)
+			if len(self.buffer) >= self.channel.batch_size:
+				self.send()
+
+	def flush(self):
+		with self.lock:
+			self.send()
+
+	def send(self):
+		if len(self.buffer) > 0:
+			self.socket.send(pickle.dumps(self.buffer, protocol=5))
+			with self.channel.sent.get_lock():
+				self.channel.sent.value += len(self.buffer)
+			self.buffer = []
+		self.last_flush = time.time()
+
+	#sends partial batches once they are flush_interval old
+	def flush_loop(self):
+		while True:
+			time.sleep(self.channel.flush_interval)
+			try:
+				with self.lock:
+					if time.time() - self.last_flush >= self.channel.flush_interval:
+						self.send()
+			except Exception as e:
+				self.logger.critical(f'Flush failed on channel {self.channel.name}', exc_info=True)
+
+
+#consumer end; requests whole batches and hands out one item at a time
+#get raises Empty after timeout seconds without a batch, or at once when a closed receiver is drained
+class ChannelReceiver:
+	def __init__(self, channel):
+		self.channel = channel
+		self.buffer = deque()
+		self.socket = None
+		self.requested = False
+		self.closed = False
+		self.lock = threading.Lock()
+
+	def connect(self):
+		self.socket = zmq.Context.instance().socket(zmq.DEALER)
+		self.socket.connect(self.channel.backend)
+
+	#stops requesting batches; the ones already taken are still handed out
+	def close(self):
+		self.closed = True
+
+	def load(self, frame):
+		batch = pickle.loads(frame)
+		with self.channel.received.get_lock():
+			self.channel.received.value += len(batch)
+		return batch
+
+	def receive(self, timeout=None):
+		if self.socket is None:
+			self.connect()
+		if self.closed:
+			return self.cancel()
+		if not self.requested:
+			self.socket.send(b'ready')
+			self.requested = True
+		if timeout is not None and not self.socket.poll(timeout * 1000):
+			raise Empty
+		batch = self.load(self.socket.recv())
+		self.requested = False
+		return batch
+
+	#withdraws a pending request; a batch the device sent before the cancel arrives ahead of its answer
+	def cancel(self):
+		batch = []
+		if self.requested:
+			self.socket.send(b'cancel')
+			frame = self.socket.recv()
+			while frame != b'':
+				batch.extend(self.load(frame))
+				frame = self.socket.recv()
+			self.requested = False
+		if len(batch) == 0:
+			raise Empty
+		return batch
+
+	def get(self, timeout=None):
+		with self.lock:
+			while len(self.buffer) == 0:
+				self.buffer.extend(self.receive(timeout))
+			return self.buffer.popleft()
+
+	def get_batch(self, timeout=None):
+		with self.lock:
+			if len(self.buffer) > 0:
+				batch = list(self.buffer)
+				self.buffer.clear()
+				return batch
+			return self.receive(timeout)
+
+	def task_done(self):
+		pass
@@ -0,0 +1,75 @@
+import os
+import json
+import msgpack
+import zstandard
+
+#frames between the processors are [topic, codec, payload]; the codec names the encoding of the payload,
+#so every hop decodes what it receives and encodes with its own WIRE_CODEC
+#a single frame is a legacy json message {'topic', 'data'}
+
+CODECS = ['msgpack', 'json']
+COMPRESSIONS = ['zstd']
+
+
+#msgpack only holds 64 bit integers; larger ones (token amounts) travel as decimal strings
+def bounded(value):
+	if isinstance(value, int) and not -2**63 <= value < 2**64:
+		return str(value)
+	if isinstance(value, dict):
+		return {k: bounded(v) for k, v in value.items()}
+	if isinstance(value, (list, tuple)):
+		return [bounded(x) for x in value]
+	return value
+
+
+class Wire:
+	def __init__(self, codec='msgpack', compression='zstd', compress_min=4096, level=3):
+		if codec not in CODECS:
+			raise ValueError(f'Unknown wire codec {codec}')
+		self.codec = codec
+		self.compression = compression if compression in COMPRESSIONS else None
+		self.compress_min = compress_min
+		self.compressor = zstandard.ZstdCompressor(level=level)
+		self.decompressor = zstandard.ZstdDecompressor()
+
+	def encode(self, topic, data):
+		if self.codec == 'msgpack':
+			try:
+				payload = msgpack.packb(data)
+			except OverflowError as e:
+				payload = msgpack.packb(bounded(data))
+		else:
+			payload = json.dumps(data).encode('UTF-8')
+		codec = self.codec
+		if self.compression and len(payload) >= self.compress_min:
+			payload = self.compressor.compress(payload)
+			codec = f'{codec}+{self.compression}'
+		return [topic.encode('UTF-8'), codec.encode('UTF-8'), payload]
+
+	def decode(self, frames):
+		if len(frames) == 1:
+			message = json.loads(frames[0])
+			return message['topic'], message['data']
+		topic, codec, payload = frames
+		codec, _, compression = codec.decode('UTF-8').partition('+')
+		if compression == 'zstd':
+			payload = self.decompressor.decompress(payload)
+		elif compression:
+			raise ValueError(f'Unknown wire compression {compression}')
+		if codec == 'msgpack':
+			data = msgpack.unpackb(payload)
+		elif codec == 'json':
+			data = json.loads(payload)
+		else:
+			raise ValueError(f'Unknown wire codec {codec}')
+		return topic.decode('UTF-8'), data
+
+	def send(self, socket, topic, data):
+		socket.send_multipart(self.encode(topic, data))
+
+	def recv(self, socket):
+		return self.decode(socket.recv_multipart())
+
+
+def from_env():
+	return Wire(os.environ.get('WIRE_CODEC', 'msgpack'), os.environ.get('WIRE_COMPRESSION', 'zstd'), int(os.environ.get('WIRE_COMPRESS_MIN', 4096)))
@@ -0,0 +1,56 @@
+import json
+import time
+import asyncio
+import logging
+import websockets
+
+
+#eth_subscribe client for logs and newHeads sharing one websocket connection
+class LogSubscription:
+	def __init__(self, url, log_filter, timeout=30):
+		self.logger = logging.getLogger("LogSubscription")
+		self.url = url
+		self.log_filter = {k: v for k, v in log_filter.items() if k in ['address', 'topics']}
+		self.timeout = timeout
+		self.socket = None
+		self.subscriptions = {}
+		#notifications that arrived while waiting for a subscribe reply, delivered first by recv
+		self.pending = []
+		self.request_id = 0
+
+	async def __aenter__(self):
+		self.socket = await websockets.connect(self.url, max_size=None, ping_interval=20, ping_timeout=self.timeout)
+		#logs first, so every block announced by newHeads afterwards has its logs delivered too
+		await self.subscribe('log', ['logs', self.log_filter])
+		await self.subscribe('head', ['newHeads'])
+		return self
+
+	async def __aexit__(self, *args):
+		await self.socket.close()
+
+	async def subscribe(self, kind, params):
+		self.request_id += 1
+		await self.socket.send(json.dumps({'jsonrpc': '2.0', 'id': self.request_id, 'method': 'eth_subscribe', 'params': params}))
+		#logs of an earlier subscription can arrive before the reply
+		deadline = time.time() + self.timeout
+		while True:
+			response = json.loads(await asyncio.wait_for(self.socket.recv(), max(0, deadline - time.time())))
+			if response.get('id') == self.request_id:
+				break
+			if response.get('method') == 'eth_subscription':
+				self.pending.append(response)
+		if 'error' in response:
+			raise ConnectionError(f"eth_subscribe {params[0]} failed: {response['error']}")
+		self.subscriptions[response['result']] = kind
+
+	#next notification as (kind, result) where kind is 'log' or 'head'
+	async def recv(self, timeout):
+		while True:
+			if len(self.pending) > 0:
+				message = self.pending.pop(0)
+			else:
+				message = json.loads(await asyncio.wait_for(self.socket.recv(), timeout))
+			params = message.get('params', {})
+			kind = self.subscriptions.get(params.get('subscription'))
+			if kind is not None:
+				return kind, params['result']
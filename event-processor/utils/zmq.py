@@ -6,20 +6,26 @@ def start_zmq(zmq_queue):
 	import zmq
 	import logging
 	import time
+	import signal
+	from queue import Empty
 	from threading import Thread
+	from utils.wire import CODECS, from_env
 
+	#pings the gateway every ZMQ_PING_INTERVAL seconds so it keeps the connection past GATEWAY_CONNECTION_TIMEOUT
 	class PingHandler(Thread):
 	    def __init__(self, zmq_handler):
-	        super().__init__()
+	        super().__init__(daemon=True)
 
 	        self.zmq_handler = zmq_handler
 	        self.running = False
 	        self.errors = 0
+	        self.interval = float(os.environ.get('ZMQ_PING_INTERVAL', 15))
 
 	    def run(self):
+	        self.running = True
 	        while self.running:
 	            self.zmq_handler.ping()
-	            time.sleep(15)
+	            time.sleep(self.interval)
 
 	class ZMQ:
 		def __init__(self, queue):
@@ -27,6 +33,9 @@ def start_zmq(zmq_queue):
 			self.context = zmq.Context()
 			self.socket = self.context.socket(zmq.PUSH)
 			self.socket.setsockopt(zmq.LINGER, 0)
+			#connect, ping and disconnect go to the gateway control port, apart from the trades
+			self.control = self.context.socket(zmq.PUSH)
+			self.control.setsockopt(zmq.LINGER, 0)
 			self.sub_socket = self.context.socket(zmq.PULL)
 
 			self.logger.info('Connecting...')
@@ -39,9 +48,31 @@ def start_zmq(zmq_queue):
 				os.environ.get('ZMQ_GATEWAY_HOST', 'gateway-processor'),
 				os.environ.get('ZMQ_GATEWAY_PORT2', 5556)))
 
+			self.control.connect("tcp://{}:{}".format(
+				os.environ.get('ZMQ_GATEWAY_HOST', 'gateway-processor'),
+				os.environ.get('ZMQ_GATEWAY_PORT4', 5558)))
+
 			self.exchange = os.environ.get('EXCHANGE', 'AVAX')
 			self.id = uuid.uuid4().hex
 			self.queue = queue
+			self.wire = from_env()
+			self.batch_size = int(os.environ.get('WIRE_BATCH', 500))
+			self.flush_interval = float(os.environ.get('WIRE_FLUSH', 0.05))
+			self.linger = float(os.environ.get('ZMQ_LINGER', 5))
+			self.running = True
+
+		#the supervisor stops the forwarder after the listeners and processors, which flushed their events into
+		#the channel before exiting; it sends the channel backlog, then exits
+		def stop(self):
+			self.running = False
+
+		#trades still queued in the sockets get up to ZMQ_LINGER seconds to reach the gateway
+		def close(self):
+			for socket in [self.socket, self.control]:
+				socket.setsockopt(zmq.LINGER, int(self.linger * 1000))
+				socket.close()
+			self.sub_socket.close(0)
+			self.context.term()
 
 		def init(self):
 			try:
@@ -50,64 +81,72 @@ def start_zmq(zmq_queue):
 				time.sleep(1)
 
 				connect_data = {
-					'topic': 'connect',
-					'data': {
-						'id': self.id,
-					}
+					'id': self.id,
+					'codecs': CODECS,
 				}
-				self.logger.info('Trying Connection', connect_data)
+				self.logger.info(f'Trying Connection {connect_data}')
 
-				self.socket.send_json(connect_data)
+				self.wire.send(self.control, 'connect', connect_data)
 
 			except Exception as e:
 				self.logger.critical('ZMQ HANDLER', exc_info=True)
 
 		def ping(self):
 			connect_data = {
-				'topic': 'ping',
-				'data': {
-					'id': self.id,
-				}
+				'id': self.id,
 			}
 
-			self.logger.info('Ping', connect_data)
+			self.logger.info(f'Ping {connect_data}')
 
 			try:
-				self.socket.send_json(connect_data)
+				self.wire.send(self.control, 'ping', connect_data)
 			except Exception as e:
-				self.logger.critical(e,exc_info=true)
+				self.logger.critical(e,exc_info=True)
 
 		def disconnect(self):
 			connect_data = {
-				'topic': 'disconnect',
-				'data': {
-					'id': self.id,
-				}
+				'id': self.id,
 			}
 
-			self.logger.info('Disconnecting', connect_data)
+			self.logger.info(f'Disconnecting {connect_data}')
 
 			try:
-				self.socket.send_json(connect_data)
+				self.wire.send(self.control, 'disconnect', connect_data)
 			except Exception as e:
 				self.logger.critical(e,exc_info=True)
 
+		#events are sent in one frame once WIRE_BATCH of them are pending or the oldest is WIRE_FLUSH seconds old
+		#returns once stopped with the channel drained and nothing pending
 		def send_trades(self):
+			events = []
+			deadline = None
 			while True:
 				try:
-					events = self.queue.get()
-
-					self.socket.send_json({
-						'topic': 'trades',
-						'data': events
-					})
-
-					self.queue.task_done()
+					try:
+						timeout = max(0, deadline - time.time()) if deadline is not None else 1
+						for items in self.queue.get_batch(timeout):
+							events.extend(items)
+						if deadline is None:
+							deadline = time.time() + self.flush_interval
+					except Empty:
+						if not self.running and deadline is None and self.queue.channel.qsize() <= 0:
+							return
+					if len(events) >= self.batch_size or (deadline is not None and time.time() >= deadline):
+						self.wire.send(self.socket, 'trades', events)
+						events = []
+						deadline = None
 				except Exception as e:
 					self.logger.critical('ZMQ HANDLER', exc_info=True)
+					events = []
+					deadline = None
 
-	zmq_handler = ZMQ(zmq_queue)
+	zmq_handler = ZMQ(zmq_queue.receiver())
 	ping_handler = PingHandler(zmq_handler)
+	signal.signal(signal.SIGTERM, lambda signum, frame: zmq_handler.stop())
 	zmq_handler.init()
 	ping_handler.start()
-	zmq_handler.send_trades()
\ No newline at end of file
+	zmq_handler.send_trades()
+	zmq_handler.logger.info('Channel drained, stopping')
+	ping_handler.running = False
+	zmq_handler.disconnect()
+	zmq_handler.close()
\ No newline at end of file
@@ -3,13 +3,46 @@ import time
 import zmq
 import sys
 import os
+import zlib
 from utils.xquery import XQuery
+from utils.trace import Trace
+from utils.dedup import DedupIndex
+from utils.wire import from_env
+from utils.flow import CreditFlow
+from utils.eventlog import EventLog
+from prometheus_client import Counter, Gauge, start_http_server
 
 POD_TOKEN_INCREMENT = 500
 FRONTEND_PORT = os.environ.get('ZMQ_GATEWAY_PORT2', 5556)
 BACKEND_PORT = os.environ.get('ZMQ_GATEWAY_PORT1', 5555)
+CREDIT_PORT = os.environ.get('ZMQ_GATEWAY_PORT3', 5557)
+#connect, ping and disconnect arrive on their own socket so a backlog of trades never delays them
+CONTROL_PORT = os.environ.get('ZMQ_GATEWAY_PORT4', 5558)
+#pub: trades go to every SUB consumer as they arrive | credit: trades are appended to the event log and consumers read it against credits
+FLOW = os.environ.get('GATEWAY_FLOW', 'pub')
+#trades are split into GATEWAY_PARTITIONS streams by xhash, chain or query so each db-processor writes its own share
+PARTITIONS = int(os.environ.get('GATEWAY_PARTITIONS', 1))
+PARTITION_KEY = os.environ.get('GATEWAY_PARTITION_KEY', 'xhash')
+#stale connections and log retention are handled on timers between polls instead of on every message
+HOUSEKEEPING_INTERVAL = float(os.environ.get('GATEWAY_HOUSEKEEPING', 5))
+RETENTION_INTERVAL = float(os.environ.get('GATEWAY_RETENTION_INTERVAL', 60))
+CONNECTION_TIMEOUT = int(os.environ.get('GATEWAY_CONNECTION_TIMEOUT', 300))
+#the event log is fsynced every GATEWAY_LOG_FSYNC_INTERVAL seconds or GATEWAY_LOG_FSYNC_BYTES bytes, on every append when both are 0
+FSYNC_INTERVAL = float(os.environ.get('GATEWAY_LOG_FSYNC_INTERVAL', 1))
+FSYNC_BYTES = int(os.environ.get('GATEWAY_LOG_FSYNC_BYTES', 0))
+#trade messages taken from the frontend before the control and credit sockets are polled again
+DATA_BURST = int(os.environ.get('GATEWAY_DATA_BURST', 100))
 connections = {}
-txs = []
+trace = Trace('gateway')
+#events are keyed on their xhash, older producers without one on the fields that identify a trade
+wire = from_env()
+index = DedupIndex(int(os.environ.get('DEDUP_CAPACITY', 100000)), float(os.environ.get('DEDUP_WINDOW', 600)))
+
+MESSAGES = Counter('xquery_gateway_messages_total', 'Messages received from the event processors by topic', ['topic'])
+EVENTS = Counter('xquery_gateway_events_total', 'Trades checked against the recent transactions', ['result'])
+CONNECTIONS = Gauge('xquery_gateway_connections', 'Subscribers with a live connection')
+BACKLOG = Gauge('xquery_gateway_backlog', 'Trade batches in the log after a consumer offset', ['consumer'])
+LOG_OFFSET = Gauge('xquery_gateway_log_offset', 'Next offset of each partition log', ['partition'])
 
 import logging
 
@@ -21,19 +54,119 @@ logging.basicConfig(
 
 logger = logging.getLogger('main.py')
 
+def partition(message):
+    if PARTITIONS == 1:
+        return 0
+    if PARTITION_KEY == 'chain':
+        key = message.get('chain_name', '')
+    elif PARTITION_KEY == 'query':
+        key = message.get('query_name', '')
+    else:
+        key = message.get('xhash', '')
+    return zlib.crc32(str(key).encode('UTF-8')) % PARTITIONS
+
+#a connection that never pinged expires CONNECTION_TIMEOUT after connecting, otherwise after its last ping
+def expire_connections():
+    now = int(time.time())
+    for connection_id in [x for x, c in connections.items() if now - (c['init'] if c['init'] != 0 else c['ping']) >= CONNECTION_TIMEOUT]:
+        logger.info('Removing connection: {}'.format(connections.pop(connection_id)))
+    CONNECTIONS.set(len(connections))
+
+def control(topic, payload):
+    if topic == 'connect':
+        logger.info(payload)
+
+        connection_id = payload['id']
+        if connection_id in connections:
+            return
+
+        connections[connection_id] = {
+            # 'limit': limit,
+            'ping': int(time.time()),
+            'init': int(time.time())
+        }
+
+        logger.info(connections[connection_id])
+
+        wire.send(backend, connection_id, connections[connection_id])
+        CONNECTIONS.set(len(connections))
+    elif topic == 'ping':
+        #a producer expired or connected before a gateway restart is registered again by its next ping
+        connection_id = payload['id']
+        if connection_id not in connections:
+            connections[connection_id] = {'init': 0}
+            CONNECTIONS.set(len(connections))
+        connections[connection_id]['init'] = 0
+        connections[connection_id]['ping'] = int(time.time())
+        logger.info(connections[connection_id])
+
+    elif topic == 'disconnect':
+        logger.info(payload)
+
+        connection_id = payload['id']
+        if connection_id in connections:
+            del connections[connection_id]
+        CONNECTIONS.set(len(connections))
+
+def trades(flow, payload):
+    data = {}
+    for message in payload:
+        item = XQuery()
+        for attr in list(message):
+            setattr(item, attr, message[attr])
+
+        key = message.get('xhash') or (item.tx_hash, item.query_name, item.chain_name, item.blocknumber, item.timestamp)
+        if not index.add(key):
+            logger.info(f'ALREADY {item.blocknumber} QUERY:{item.query_name} XHASH:{item.xhash} TX:{item.tx_hash}')
+            EVENTS.labels('duplicate').inc()
+
+            continue
+        else:
+            logger.info(f'PASSED {item.blocknumber} QUERY:{item.query_name} XHASH:{item.xhash} TX:{item.tx_hash}')
+            EVENTS.labels('passed').inc()
+            data.setdefault(partition(message), []).append(message)
+            trace.stamp(item.xhash, gateway=time.time())
+
+    #pub subscribers filter on the partition topic
+    for p, batch in data.items():
+        if flow is not None:
+            flow.publish(p, wire.encode('trades', batch))
+            LOG_OFFSET.labels(p).set(flow.logs[p].next_offset)
+        else:
+            wire.send(backend, f'trades.{p}', batch)
+    if flow is not None and len(data) > 0:
+        for consumer, batches in flow.backlog().items():
+            BACKLOG.labels(consumer).set(batches)
+
+#producers from before the control socket still send their control topics on the frontend
+def dispatch(flow, socket):
+    topic, payload = wire.recv(socket)
+    MESSAGES.labels(topic).inc()
+    if topic == 'trades':
+        trades(flow, payload)
+    else:
+        control(topic, payload)
+
 def main():
-    global frontend, backend, context, txs
+    global frontend, backend, controls, context
+    flow = None
     try:
         logger.info('Initializing')
+        start_http_server(int(os.environ.get('METRICS_PORT', 9100)))
 
         context = zmq.Context()
 
         frontend = context.socket(zmq.PULL)
-        frontend.set_hwm(0)
+        frontend.set_hwm(int(os.environ.get('GATEWAY_HWM', 1000)))
         frontend.bind("tcp://*:{}".format(FRONTEND_PORT))
 
         logger.info('Frontend listening on port {}'.format(FRONTEND_PORT))
 
+        controls = context.socket(zmq.PULL)
+        controls.setsockopt(zmq.LINGER, 0)
+        controls.bind("tcp://*:{}".format(CONTROL_PORT))
+        logger.info('Control listening on port {}'.format(CONTROL_PORT))
+
         # backend = context.socket(zmq.PUSH)
         backend = context.socket(zmq.PUB)
         backend.set_hwm(0)
@@ -41,95 +174,74 @@ def main():
         backend.bind("tcp://*:{}".format(BACKEND_PORT))
         logger.info('Backend listening on port {}'.format(BACKEND_PORT))
 
+        poller = zmq.Poller()
+        poller.register(controls, zmq.POLLIN)
+        poller.register(frontend, zmq.POLLIN)
+        if FLOW == 'credit':
+            credits = context.socket(zmq.ROUTER)
+            credits.setsockopt(zmq.LINGER, 0)
+            credits.bind("tcp://*:{}".format(CREDIT_PORT))
+            flow = CreditFlow(credits, [EventLog(os.path.join(os.environ.get('GATEWAY_LOG_DIR', '/tmp/xquery-log'), str(p)),
+                segment_bytes=int(os.environ.get('GATEWAY_LOG_SEGMENT', 64 * 2**20)),
+                retention=float(os.environ.get('GATEWAY_LOG_RETENTION', 7 * 86400)),
+                max_bytes=int(os.environ.get('GATEWAY_LOG_MAX_BYTES', 0)),
+                fsync_interval=FSYNC_INTERVAL,
+                fsync_bytes=FSYNC_BYTES) for p in range(0, PARTITIONS)])
+            poller.register(credits, zmq.POLLIN)
+            logger.info('Credit flow listening on port {} log offsets {}'.format(CREDIT_PORT, [x.next_offset for x in flow.logs]))
+
+        #[next run, interval, task]
+        timers = [[time.time() + HOUSEKEEPING_INTERVAL, HOUSEKEEPING_INTERVAL, expire_connections]]
+        if flow is not None:
+            timers.append([time.time() + RETENTION_INTERVAL, RETENTION_INTERVAL, lambda: [log.retain() for log in flow.logs]])
+            if FSYNC_INTERVAL > 0:
+                timers.append([time.time() + FSYNC_INTERVAL, FSYNC_INTERVAL, lambda: [log.sync() for log in flow.logs]])
 
         while True:
             try:
-                if len(txs) >= 1000:
-                    txs = txs[1000:]
-
-                try:
-                    for connection in connections.copy():
-                        if connections[connection]['init'] != 0 and (int(time.time()) - connections[connection]['init']) >= 300:
-                            logger.info('Removing connection: {}'.format(connections[connection]))
-                            del connections[connection]
-
-                        if connections[connection]['init'] == 0 and (int(time.time()) - connections[connection]['ping']) >= 300:
-                            logger.info('Removing connection: {}'.format(connections[connection]))
-                            del connections[connection]
-                except Exception as e:
-                    logger.critical("Exception: ",exc_info=True)
-
-                msg = frontend.recv()
-                j = json.loads(msg)
-
-                data = []
-                if j['topic'] == 'trades':
-                    for message in j['data']:
-                        item = XQuery()
-                        for attr in list(message):
-                            setattr(item, attr, message[attr])
-
-                        if any((x.tx_hash == item.tx_hash and x.query_name == item.query_name and x.chain_name == item.chain_name and x.blocknumber == item.blocknumber and x.timestamp == item.timestamp) for x in txs):
-                            logger.info(f'ALREADY {item.blocknumber} QUERY:{item.query_name} XHASH:{item.xhash} TX:{item.tx_hash}')
-
-                            continue
-                        else:
-                            logger.info(f'PASSED {item.blocknumber} QUERY:{item.query_name} XHASH:{item.xhash} TX:{item.tx_hash}')
-                            data.append(message)
-                            txs.insert(0, item)
-
-                    backend.send_json({
-                        'topic': 'trades',
-                        'data': data
-                    })
-                elif j['topic'] == 'connect':
-                    logger.info(j)
-
-                    connection_id = j['data']['id']
-                    if connection_id in connections:
-                        continue
-
-                    connections[connection_id] = {
-                        # 'limit': limit,
-                        'ping': int(time.time()),
-                        'init': int(time.time())
-                    }
-
-                    logger.info(connections[connection_id])
-
-                    backend.send_json({
-                        'topic': connection_id,
-                        'data': connections[connection_id]
-                    })
-                    continue
-                elif j['topic'] == 'ping':
-                    connection_id = j['data']['id']
-                    if connection_id in connections:
-                        connections[connection_id]['init'] = 0
-                        connections[connection_id]['ping'] = int(time.time())
-                        logger.info(connections[connection_id])
-
-                elif j['topic'] == 'disconnect':
-                    logger.info(j)
-
-                    connection_id = j['data']['id']
-                    if connection_id in connections:
-                        del connections[connection_id]
+                for timer in timers:
+                    if time.time() >= timer[0]:
+                        try:
+                            timer[2]()
+                        except Exception as e:
+                            logger.critical("Exception: ",exc_info=True)
+                        timer[0] = time.time() + timer[1]
+
+                events = dict(poller.poll(max(0, min(x[0] for x in timers) - time.time()) * 1000))
+
+                #control first, then consumer credits, then at most DATA_BURST trade messages
+                while controls in events and controls.poll(0):
+                    dispatch(flow, controls)
+                while flow is not None and flow.socket in events and flow.socket.poll(0):
+                    flow.receive()
+                for i in range(0, DATA_BURST):
+                    if frontend not in events or not frontend.poll(0):
+                        break
+                    dispatch(flow, frontend)
             except Exception as e:
                 logger.critical("Exception: ",exc_info=True)
 
     except Exception as e:
         logger.critical('Closing sockets',exc_info=True)
         frontend.close()
+        controls.close()
         backend.close()
+        if flow is not None:
+            flow.socket.close()
         context.term()
         logger.critical('Closed',exc_info=True)
     finally:
         logger.info('Closing sockets')
         frontend.close()
+        controls.close()
         backend.close()
+        if flow is not None:
+            flow.socket.close()
         context.term()
         logger.info('Closed')
+        if flow is not None:
+            for log in flow.logs:
+                log.sync()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,31 @@
+import time
+from collections import OrderedDict
+
+
+#keys of recently passed events in arrival order, bounded by count and age so lookups stay O(1)
+#and memory stays fixed however many chains publish through the gateway
+class DedupIndex:
+    def __init__(self, capacity=100000, window=600):
+        self.capacity = capacity
+        self.window = window
+        self.entries = OrderedDict()
+
+    def evict(self, now):
+        while len(self.entries) > 0:
+            key, seen = next(iter(self.entries.items()))
+            if len(self.entries) <= self.capacity and now - seen < self.window:
+                break
+            self.entries.popitem(last=False)
+
+    #True the first time a key is seen within the window
+    def add(self, key):
+        now = time.time()
+        if key in self.entries and now - self.entries[key] < self.window:
+            return False
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        self.evict(now)
+        return True
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,177 @@
+import os
+import glob
+import time
+import struct
+import logging
+import msgpack
+
+HEADER = struct.Struct('<QI')
+
+
+#append-only log of accepted trade batches; every batch gets the next offset and segment files are named
+#after the first offset they hold, so any offset is found from the file names and a scan of one segment
+#records are [offset, length] headers followed by the msgpack encoded wire frames
+#appends are fsynced once fsync_interval seconds or fsync_bytes bytes are pending, or on every append when both are 0
+class EventLog:
+    def __init__(self, path, segment_bytes=64 * 2**20, retention=7 * 86400, max_bytes=0, fsync_interval=1.0, fsync_bytes=0):
+        self.logger = logging.getLogger('EventLog')
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self.unsynced = 0
+        self.synced = time.time()
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(os.path.basename(x).split('.')[0]) for x in glob.glob(os.path.join(path, '*.log')))
+        self.next_offset = self.recover()
+        self.writer = open(self.segment(self.segments[-1]), 'ab') if len(self.segments) > 0 else None
+
+    def segment(self, base):
+        return os.path.join(self.path, f'{base:020d}.log')
+
+    #next offset after the last complete record; a record torn by a crash is cut off
+    def recover(self):
+        if len(self.segments) == 0:
+            return 0
+        name = self.segment(self.segments[-1])
+        offset = self.segments[-1]
+        end = 0
+        with open(name, 'rb') as file:
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                record, length = HEADER.unpack(header)
+                if len(file.read(length)) < length:
+                    break
+                offset = record + 1
+                end = file.tell()
+        if end < os.path.getsize(name):
+            self.logger.info(f'Truncating torn record at {name}:{end}')
+            os.truncate(name, end)
+        return offset
+
+    @property
+    def first_offset(self):
+        return self.segments[0] if len(self.segments) > 0 else self.next_offset
+
+    def append(self, frames):
+        if self.writer is None or self.writer.tell() >= self.segment_bytes:
+            self.roll()
+        offset = self.next_offset
+        record = msgpack.packb(frames)
+        self.writer.write(HEADER.pack(offset, len(record)) + record)
+        self.writer.flush()
+        self.unsynced += HEADER.size + len(record)
+        self.next_offset += 1
+        if self.fsync_due():
+            self.sync()
+        return offset
+
+    def fsync_due(self):
+        if self.fsync_interval <= 0 and self.fsync_bytes <= 0:
+            return True
+        if self.fsync_bytes > 0 and self.unsynced >= self.fsync_bytes:
+            return True
+        return self.fsync_interval > 0 and time.time() - self.synced >= self.fsync_interval
+
+    #writes the appended records through to disk; also run on a timer so an idle log is not left unsynced
+    def sync(self):
+        if self.writer is not None and self.unsynced > 0:
+            os.fsync(self.writer.fileno())
+        self.unsynced = 0
+        self.synced = time.time()
+
+    #a full segment is synced before it is closed, and the directory once the new segment exists
+    def roll(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+        self.segments.append(self.next_offset)
+        self.writer = open(self.segment(self.next_offset), 'ab')
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.retain()
+
+    #whole segments older than retention or beyond max_bytes are dropped, never the one being written
+    def retain(self):
+        sizes = {base: os.path.getsize(self.segment(base)) for base in self.segments}
+        total = sum(sizes.values())
+        while len(self.segments) > 1:
+            base = self.segments[0]
+            expired = self.retention > 0 and time.time() - os.path.getmtime(self.segment(base)) > self.retention
+            oversize = self.max_bytes > 0 and total > self.max_bytes
+            if not expired and not oversize:
+                break
+            os.remove(self.segment(base))
+            total -= sizes[base]
+            self.segments.pop(0)
+            self.logger.info(f'Dropped segment {base}, log starts at {self.first_offset}')
+
+    def reader(self, offset):
+        return LogReader(self, max(offset, self.first_offset))
+
+
+#sequential cursor over the log for one consumer; keeps its file open so a replay reads at disk speed
+class LogReader:
+    def __init__(self, log, offset):
+        self.log = log
+        self.offset = offset
+        self.file = None
+        self.base = None
+        self.pending = None
+
+    def open(self):
+        if self.file is not None:
+            self.file.close()
+        self.base = max([x for x in self.log.segments if x <= self.offset] or [self.log.first_offset])
+        self.file = open(self.log.segment(self.base), 'rb')
+        #skip the records before the offset by their headers only
+        while True:
+            position = self.file.tell()
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                self.file.seek(position)
+                return
+            record, length = HEADER.unpack(header)
+            if record >= self.offset:
+                self.file.seek(position)
+                return
+            self.file.seek(length, os.SEEK_CUR)
+
+    #(offset, frames) of the next record without consuming it, None at the end of the log
+    def peek(self):
+        if self.pending is not None:
+            return self.pending
+        if self.offset >= self.log.next_offset:
+            return None
+        #a reader left behind by retention continues at the oldest kept record
+        if self.file is None or self.offset < self.log.first_offset:
+            self.offset = max(self.offset, self.log.first_offset)
+            self.open()
+        position = self.file.tell()
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            #end of a rolled segment, the next one starts at this offset
+            self.file.seek(position)
+            if any(x > self.base for x in self.log.segments):
+                self.open()
+                return self.peek()
+            return None
+        record, length = HEADER.unpack(header)
+        self.pending = (record, msgpack.unpackb(self.file.read(length)))
+        return self.pending
+
+    def advance(self):
+        record, frames = self.pending
+        self.pending = None
+        self.offset = record + 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
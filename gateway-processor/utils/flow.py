@@ -0,0 +1,68 @@
+import logging
+import zmq
+
+
+#credit-based delivery of the partition logs: a consumer subscribes to each partition it claims from the offset
+#after the last batch it committed there, and receives [partition, offset, topic, codec, payload] frames only
+#against credits it granted, so a slow or absent database leaves its backlog in the log instead of memory
+#consumers send ['subscribe', window, offset, partition] when they (re)start, a negative offset meaning the end
+#of the log, and ['credit', n, partition] once n batches of the partition are committed
+class CreditFlow:
+    def __init__(self, socket, logs):
+        self.logger = logging.getLogger('CreditFlow')
+        self.socket = socket
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.logs = logs
+        self.subscriptions = {}
+
+    def receive(self):
+        identity, command, *values = self.socket.recv_multipart()
+        #the partition is optional and defaults to 0
+        values = [int(x) for x in values] + [0]
+        partition = values[2] if command == b'subscribe' else values[1]
+        if partition >= len(self.logs):
+            self.logger.info(f'Consumer {identity.decode("UTF-8")} asked for unknown partition {partition}')
+            return
+        key = (identity, partition)
+        if command == b'subscribe':
+            window, offset = values[0], values[1]
+            log = self.logs[partition]
+            if offset < 0:
+                offset = log.next_offset
+            if key in self.subscriptions:
+                self.subscriptions[key]['reader'].close()
+            reader = log.reader(offset)
+            self.subscriptions[key] = {'credit': window, 'reader': reader}
+            self.logger.info(f'Consumer {identity.decode("UTF-8")} partition {partition} from offset {reader.offset} window {window} backlog {log.next_offset - reader.offset}')
+        elif command == b'credit' and key in self.subscriptions:
+            self.subscriptions[key]['credit'] += values[0]
+        if key in self.subscriptions:
+            self.drain(key)
+
+    def publish(self, partition, frames):
+        self.logs[partition].append(frames)
+        for key in [x for x in self.subscriptions if x[1] == partition]:
+            self.drain(key)
+
+    #a consumer that went away is forgotten; it subscribes again from its own committed offsets
+    def drain(self, key):
+        identity, partition = key
+        subscription = self.subscriptions[key]
+        while subscription['credit'] > 0:
+            record = subscription['reader'].peek()
+            if record is None:
+                return
+            offset, frames = record
+            try:
+                self.socket.send_multipart([identity, str(partition).encode('UTF-8'), str(offset).encode('UTF-8')] + frames, zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                self.logger.info(f'Consumer {identity.decode("UTF-8")} gone at partition {partition} offset {offset}')
+                for gone in [x for x in self.subscriptions if x[0] == identity]:
+                    self.subscriptions.pop(gone)['reader'].close()
+                return
+            subscription['reader'].advance()
+            subscription['credit'] -= 1
+
+    def backlog(self):
+        return {f'{identity.decode("UTF-8")}-{partition}': self.logs[partition].next_offset - x['reader'].offset for (identity, partition), x in self.subscriptions.items()}
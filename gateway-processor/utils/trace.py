@@ -0,0 +1,23 @@
+import os
+import json
+import threading
+
+
+#stage timestamps of published events, written only when BENCH_TRACE names a directory; read by bench/run.py
+class Trace:
+    def __init__(self, service):
+        self.service = service
+        self.directory = os.environ.get('BENCH_TRACE')
+        self.file = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def stamp(self, xhash, **stages):
+        if not self.directory:
+            return
+        with self.lock:
+            #one file per process, reopened after a fork
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.file = open(os.path.join(self.directory, f'{self.service}-{self.pid}.jsonl'), 'a', buffering=1)
+            self.file.write(json.dumps({'xhash': xhash, **stages}) + '\n')